@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# measures how much memory ffcli-server uses while relaying a large fetch to a client that reads slowly
+#
+# the client reads --rate bytes/sec for --duration seconds while the stand-in extension
+# sends the body as fast as the server lets it
+# with backpressure the server's rss should stay flat however large the body is
+#
+# to compare against an older server:
+#   git show REV:ffcli-server > /tmp/ffcli-server.old
+#   bench/backpressure.py --server /tmp/ffcli-server.old
+
+import time
+import json
+import asyncio
+import argparse
+
+from fake_extension import FakeExtension, DEFAULT_SERVER
+
+async def slow_client(socket_path, size, rate, duration):
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=2**24)
+    writer.write(json.dumps({'id': 1, 'fn': 'fetch', 'args': [f'bench://{size}', {}]}).encode('utf8') + b'\n')
+    await writer.drain()
+
+    received = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        if not (data := await reader.read(2**14)):
+            break
+        received += len(data)
+        # sleep until we are back under the rate
+        await asyncio.sleep(max(0, received / rate - (time.perf_counter() - start)))
+    writer.close()
+    return received
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--legacy', action='store_true', help='Send replies without the routing header, for older servers')
+    parser.add_argument('--size', type=int, default=2**30, help='Size of the fetched body')
+    parser.add_argument('--rate', type=float, default=2**20, help='Bytes/sec read by the client')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    async with FakeExtension(args.server, legacy=args.legacy) as ext:
+        before = ext.rss()
+        client = asyncio.create_task(slow_client(ext.socket_path, args.size, args.rate, args.duration))
+        peak = before
+        while not client.done():
+            peak = max(peak, ext.rss())
+            await asyncio.sleep(0.05)
+        received = await client
+
+    print(f'client received:  {received / 2**20:.1f} MB')
+    print(f'server rss:       {before / 2**20:.1f} MB at start, {peak / 2**20:.1f} MB peak')
+
+if __name__ == '__main__':
+    asyncio.run(main())
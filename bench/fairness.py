@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# measures how long a light client waits for answers while a heavy client saturates the pipe to the extension
+#
+# the heavy client keeps --in-flight large requests queued at all times,
+# the light client sends a small request every --interval seconds and records its latency
+# with a fair server the light client's p99 should stay close to its latency without the heavy client
+#
+# to compare against an older server:
+#   git show REV:ffcli-server > /tmp/ffcli-server.old
+#   bench/fairness.py --server /tmp/ffcli-server.old
+
+import time
+import json
+import asyncio
+import argparse
+import statistics
+
+from fake_extension import FakeExtension, DEFAULT_SERVER
+
+async def heavy_client(socket_path, size, in_flight, stop):
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=2**24)
+    request = json.dumps({'fn': 'sink', 'args': ['x' * size]})
+    slots = asyncio.Semaphore(in_flight)
+    sent = 0
+
+    async def read():
+        while await reader.readline():
+            slots.release()
+
+    reading = asyncio.create_task(read())
+    while not stop.is_set():
+        await slots.acquire()
+        sent += 1
+        writer.write(b'{"id":%d,' % sent + request[1:].encode('utf8') + b'\n')
+        await writer.drain()
+    reading.cancel()
+    writer.close()
+    return sent
+
+async def light_client(socket_path, count, interval):
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=2**24)
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        writer.write(json.dumps({'id': i, 'fn': 'status', 'args': []}).encode('utf8') + b'\n')
+        await writer.drain()
+        await reader.readline()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    writer.close()
+    return latencies
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return f'p50 {p(0.5):.2f}ms, p99 {p(0.99):.2f}ms, max {latencies[-1] * 1000:.2f}ms, mean {statistics.mean(latencies) * 1000:.2f}ms'
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--legacy', action='store_true', help='Send replies without the routing header, for older servers')
+    parser.add_argument('-n', '--requests', type=int, default=200, help='Requests sent by the light client')
+    parser.add_argument('--interval', type=float, default=0.005)
+    parser.add_argument('--size', type=int, default=2**16, help='Size of each heavy request')
+    parser.add_argument('--in-flight', type=int, default=64, help='Requests the heavy client keeps queued')
+    args = parser.parse_args()
+
+    async with FakeExtension(args.server, legacy=args.legacy) as ext:
+        alone = await light_client(ext.socket_path, args.requests, args.interval)
+
+        stop = asyncio.Event()
+        heavy = asyncio.create_task(heavy_client(ext.socket_path, args.size, args.in_flight, stop))
+        # let it fill up the pipe
+        await asyncio.sleep(0.5)
+        start = time.perf_counter()
+        loaded = await light_client(ext.socket_path, args.requests, args.interval)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sent = await heavy
+
+    print(f'light client alone:      {summary(alone)}')
+    print(f'with heavy client:       {summary(loaded)}')
+    print(f'heavy client throughput: {sent * args.size / elapsed / 2**20:.1f} MB/s (approx)')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# a stand-in for the web extension
+# it launches ffcli-server the same way the browser does and answers requests over the native messaging pipe
+
+import os
+import sys
+import struct
+import base64
+import json
+import asyncio
+import tempfile
+import shutil
+
+DEFAULT_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'ffcli-server')
+
+def encode(item):
+    return json.dumps(item, separators=(',', ':')).encode('utf8')
+
+class FakeExtension:
+    def __init__(self, server=DEFAULT_SERVER, legacy=False):
+        self.server = server
+        # legacy extensions do not send the routing header
+        self.legacy = legacy
+        self.profile_dir = None
+        self.proc = None
+        self.tasks = set()
+        self.handlers = {
+            'status': self.status,
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+            'id': self.id,
+            'userAgent': self.user_agent,
+            'browser.cookies.getAll': self.get_cookies,
+            'sink': self.sink,
+            'fetch': self.fetch,
+            'sleep': self.sleep,
+            'batch': self.batch,
+        }
+        # (_id, id) -> handler task, for cancelling
+        self.running = {}
+        # body bytes sent by fetch
+        self.fetched = 0
+        # (_id, id) -> event that is clear while ffcli-server has paused the request
+        self.flow = {}
+        self.disconnected = set()
+
+    @property
+    def socket_path(self):
+        return self.profile_dir + '/ffcli.sock'
+
+    async def start(self):
+        self.profile_dir = tempfile.mkdtemp(prefix='ffcli-bench-')
+        env = {
+            **os.environ,
+            # this is how ffcli-server finds the profile dir under firefox
+            'MOZ_CRASHREPORTER_EVENTS_DIRECTORY': os.path.join(self.profile_dir, 'crashes', 'events'),
+        }
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, self.server,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        self.write(encode({'ffcliId': 'bench', 'extensionId': 'bench'}))
+        await self.read()
+        while not os.path.exists(self.socket_path):
+            await asyncio.sleep(0.01)
+        self.reader = asyncio.create_task(self.read_requests())
+
+    async def stop(self):
+        self.reader.cancel()
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(self.reader, *self.tasks, return_exceptions=True)
+        self.proc.stdin.close()
+        # the process only counts as done once its stdout is at eof
+        await self.proc.stdout.read()
+        await self.proc.wait()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def rss(self):
+        # memory used by ffcli-server
+        with open(f'/proc/{self.proc.pid}/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def write(self, data):
+        self.proc.stdin.write(struct.pack('I', len(data)))
+        self.proc.stdin.write(data)
+
+    async def read(self):
+        length, = struct.unpack('I', await self.proc.stdout.readexactly(4))
+        return json.loads(await self.proc.stdout.readexactly(length))
+
+    def reply_prefix(self, msg, complete=False):
+        # the start of a reply, up to and including the id
+        id = encode(msg.get('id'))
+        if self.legacy:
+            return b'{"_id":%d,"id":%s,' % (msg['_id'], id)
+        return b'{"_h":[%d,%s,%s],"id":%s,' % (msg['_id'], b'true' if complete else b'false', id, id)
+
+    def send(self, msg, data, type='data', complete=False):
+        fields = {'type': type, 'data': data}
+        if complete:
+            fields['complete'] = True
+        self.write(self.reply_prefix(msg, complete) + encode(fields)[1:])
+
+    async def read_requests(self):
+        while True:
+            msg = await self.read()
+            if msg.get('type') == 'disconnect':
+                self.disconnected.add(msg['_id'])
+                for key, event in list(self.flow.items()):
+                    if key[0] == msg['_id']:
+                        event.set()
+                continue
+            if msg.get('type') in ('pause', 'resume'):
+                event = self.flow.setdefault((msg['_id'], msg['id']), asyncio.Event())
+                if msg['type'] == 'pause':
+                    event.clear()
+                else:
+                    event.set()
+                continue
+            if msg.get('type') == 'cancel':
+                if task := self.running.get((msg['_id'], msg['id'])):
+                    task.cancelled_by_client = True
+                    task.cancel()
+                continue
+            task = asyncio.create_task(self.handle(msg))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, msg):
+        handler = self.handlers.get(msg.get('fn'))
+        key = (msg['_id'], msg.get('id'))
+        self.running[key] = asyncio.current_task()
+        try:
+            if handler is None:
+                raise Exception(f'no such function {msg.get("fn")}')
+            value = await asyncio.wait_for(handler(msg, *msg.get('args', ())), msg.get('timeout'))
+        except asyncio.CancelledError:
+            if not getattr(asyncio.current_task(), 'cancelled_by_client', False):
+                raise
+            self.send(msg, {'error': 'cancelled'}, type='error', complete=True)
+        except TimeoutError:
+            self.send(msg, {'error': f'timed out after {msg["timeout"]}s'}, type='error', complete=True)
+        except Exception as e:
+            self.send(msg, {'error': str(e)}, type='error', complete=True)
+        else:
+            self.send(msg, value, complete=True)
+        finally:
+            self.running.pop(key, None)
+        await self.proc.stdin.drain()
+
+    async def status(self, msg):
+        return True
+
+    async def id(self, msg):
+        return 'bench@ffcli'
+
+    async def user_agent(self, msg, tab=None):
+        return USER_AGENT
+
+    async def get_cookies(self, msg, query):
+        return [COOKIE]
+
+    async def sleep(self, msg, seconds):
+        await asyncio.sleep(seconds)
+        return True
+
+    async def batch(self, msg, calls):
+        # like index.mjs, each call succeeds or fails on its own
+        async def call(fn, args=()):
+            try:
+                if fn in ('batch', 'subscribe', 'fetch') or (handler := self.handlers.get(fn)) is None:
+                    raise Exception(f'no such function {fn}')
+                return {'type': 'data', 'data': await handler(msg, *args)}
+            except Exception as e:
+                return {'type': 'error', 'data': {'error': str(e)}}
+        return await asyncio.gather(*(call(c['fn'], c.get('args') or ()) for c in calls))
+
+    async def sink(self, msg, *args):
+        # takes any amount of data and answers with nothing
+        return None
+
+    async def fetch(self, msg, url, opts=None):
+        # streams a body of the size given in the url, e.g. bench://1000000
+        # and stops reading it while paused, like fetch.mjs
+        size = int(url.partition('://')[2])
+        self.send(msg, {'type': 'response', 'data': {'status': 200, 'statusText': 'OK', 'headers': {}, 'url': url}})
+        chunk = base64.b64encode(b'x' * 2**16).decode('ascii')
+        data = self.reply_prefix(msg) + encode({'type': 'data', 'data': {'type': 'responseBody', 'data': chunk}})[1:]
+        header = struct.pack('I', len(data))
+        flow = self.flow.setdefault((msg['_id'], msg['id']), asyncio.Event())
+        flow.set()
+        try:
+            for i in range(0, size, 2**16):
+                await flow.wait()
+                if msg['_id'] in self.disconnected:
+                    break
+                self.proc.stdin.write(header)
+                self.proc.stdin.write(data)
+                self.fetched += 2**16
+                await self.proc.stdin.drain()
+        finally:
+            self.flow.pop((msg['_id'], msg['id']), None)
+
+    async def unsubscribe(self, msg, sub_id):
+        # subscriptions here end by themselves
+        return None
+
+    async def subscribe(self, msg, event, num_events=None, *args):
+        # emits num_events copies of a canned event as fast as possible
+        self.send(msg, {'subscriptionId': 'bench'})
+        event = [EVENT]
+        # pre-encode since we are measuring the relay, not ourselves
+        data = self.reply_prefix(msg) + encode({'type': 'data', 'data': event})[1:]
+        header = struct.pack('I', len(data))
+        for i in range(num_events or 0):
+            self.proc.stdin.write(header)
+            self.proc.stdin.write(data)
+            if i % 100 == 0:
+                await self.proc.stdin.drain()
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:130.0) Gecko/20100101 Firefox/130.0'
+
+COOKIE = {
+    'name': 'session',
+    'value': '0123456789abcdef',
+    'domain': 'example.com',
+    'hostOnly': True,
+    'path': '/',
+    'secure': False,
+    'httpOnly': True,
+    'sameSite': 'lax',
+    'session': True,
+    'firstPartyDomain': '',
+    'partitionKey': None,
+    'storeId': 'firefox-default',
+}
+
+# roughly what browser.webRequest.onBeforeRequest sends
+EVENT = {
+    'requestId': '12345',
+    'url': 'https://example.com/some/path/to/a/resource.js?with=a&query=string',
+    'originUrl': 'https://example.com/',
+    'documentUrl': 'https://example.com/',
+    'method': 'GET',
+    'type': 'script',
+    'timeStamp': 1700000000000.123,
+    'tabId': 12,
+    'frameId': 0,
+    'parentFrameId': -1,
+    'incognito': False,
+    'thirdParty': False,
+    'cookieStoreId': 'firefox-default',
+    'proxyInfo': None,
+    'ip': None,
+    'frameAncestors': [],
+    'urlClassification': {'firstParty': [], 'thirdParty': []},
+    'requestSize': 0,
+    'responseSize': 0,
+}
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# measures requests/sec of Client.fake_fetch against a local keep-alive http server
+#
+# --urllib runs the same requests the way fake_fetch used to make them,
+# with a new urllib opener (and connection) per request in an executor thread
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import multiprocessing
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ffcli
+from fake_extension import FakeExtension
+
+async def handle_http(body, reader, writer):
+    response = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+    try:
+        while head := await reader.readuntil(b'\r\n\r\n'):
+            head = head.lower()
+            if b'content-length:' in head:
+                await reader.readexactly(int(head.split(b'content-length:')[1].split(b'\r\n')[0]))
+            writer.write(response)
+            if b'connection: close' in head:
+                break
+            await writer.drain()
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+def serve_http(port, size, ready):
+    async def main():
+        server = await asyncio.start_server(partial(handle_http, b'x' * size), '127.0.0.1', port)
+        ready.set()
+        await server.serve_forever()
+    asyncio.run(main())
+
+async def urllib_fetch(client, url):
+    import urllib.request
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    # the same lookups as fake_fetch
+    cookies = await client.get_cookies(url)
+    headers = {'User-Agent': await client.get_user_agent(), 'Cookie': '; '.join(c['name']+'='+c['value'] for c in cookies)}
+
+    def thread():
+        send = partial(loop.call_soon_threadsafe, queue.put_nowait)
+        response = urllib.request.build_opener().open(urllib.request.Request(url, headers=headers))
+        while data := response.read1():
+            send(data)
+
+    fut = asyncio.ensure_future(loop.run_in_executor(None, thread))
+    fut.add_done_callback(lambda f: queue.put_nowait(None))
+    size = 0
+    while data := await queue.get():
+        size += len(data)
+    await fut
+    return size
+
+async def pooled_fetch(client, url):
+    size = 0
+    async for data in client.fake_fetch(url).read():
+        size += len(data)
+    return size
+
+async def run(fetch, url, num_requests, concurrency):
+    remaining = iter(range(num_requests))
+    sizes = []
+
+    async def worker():
+        for _ in remaining:
+            sizes.append(await fetch(url))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return num_requests / (time.perf_counter() - start), sum(sizes)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--urllib', action='store_true', help='Use a new urllib opener per request, like fake_fetch used to')
+    parser.add_argument('-n', '--num-requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('-s', '--size', type=int, default=16384, help='Response body size')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    port = ffcli.get_free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_http, args=(port, args.size, ready), daemon=True)
+    server.start()
+    ready.wait()
+    url = f'http://127.0.0.1:{port}/'
+
+    try:
+        async with FakeExtension() as ext:
+            async with ffcli.Client(ext.profile_dir, http_pool={'max_per_host': args.concurrency}) as client:
+                fetch = partial(urllib_fetch if args.urllib else pooled_fetch, client)
+                # warm up
+                await run(fetch, url, args.concurrency, args.concurrency)
+                results = []
+                for _ in range(args.repeat):
+                    rate, size = await run(fetch, url, args.num_requests, args.concurrency)
+                    assert size == args.num_requests * args.size
+                    results.append(rate)
+                stats = client.http.stats()
+    finally:
+        server.terminate()
+
+    print(f'{"urllib" if args.urllib else "fake_fetch"}: {args.num_requests} requests x {args.size} bytes, concurrency {args.concurrency}')
+    print(f'requests/sec: best {max(results):.0f}, mean {sum(results) / len(results):.0f}')
+    if not args.urllib:
+        print('connections:', stats)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# measures how many messages/sec ffcli-server can relay from the extension to socket clients
+#
+# to compare against an older server:
+#   git show REV:ffcli-server > /tmp/ffcli-server.old
+#   bench/relay.py --server /tmp/ffcli-server.old --legacy
+
+import time
+import json
+import asyncio
+import argparse
+
+from fake_extension import FakeExtension, DEFAULT_SERVER
+
+async def run_client(socket_path, id, num_events):
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=2**24)
+    request = {'id': id, 'fn': 'subscribe', 'args': ['browser.webRequest.onBeforeRequest', num_events]}
+    writer.write(json.dumps(request).encode('utf8') + b'\n')
+    await writer.drain()
+
+    count = 0
+    while line := await reader.readline():
+        count += 1
+        # only look for the final message, like a client that does not care about every event
+        if b'"complete":true' in line or b'"complete": true' in line:
+            break
+    writer.close()
+    return count
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--legacy', action='store_true', help='Send replies without the routing header, for older servers')
+    parser.add_argument('-n', '--num-events', type=int, default=100000)
+    parser.add_argument('-c', '--clients', type=int, default=1)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    async with FakeExtension(args.server, legacy=args.legacy) as ext:
+        # warm up
+        await run_client(ext.socket_path, 0, 100)
+
+        results = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            counts = await asyncio.gather(*(run_client(ext.socket_path, i, args.num_events) for i in range(args.clients)))
+            elapsed = time.perf_counter() - start
+            results.append(sum(counts) / elapsed)
+
+    print(f'{args.clients} client(s) x {args.num_events} events')
+    print(f'messages/sec: best {max(results):.0f}, mean {sum(results) / len(results):.0f}')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# measures how long ffcli.py takes to start
+#   * import time of ffcli, from python -X importtime
+#   * wall clock time of `ffcli.py do status` against a stub socket that answers every request immediately
+# with --json the results are printed as a single json object, e.g. to track in CI
+# with --check it exits non-zero if ffcli imports any of the modules that should only be loaded on demand
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FFCLI = os.path.join(ROOT, 'ffcli.py')
+
+# only needed by some subcommands (ssl and subprocess are imported by asyncio anyway)
+LAZY_MODULES = (
+    'csv',
+    'configparser',
+    'email.utils',
+    'urllib.request',
+    'http.cookies',
+    'http.cookiejar',
+    'shlex',
+)
+
+async def run(*args, **kwargs):
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise Exception(f'{args} failed: {stderr.decode()}')
+    return stdout, stderr
+
+async def import_times():
+    _, stderr = await run(sys.executable, '-X', 'importtime', '-c', 'import ffcli', cwd=ROOT)
+    times = {}
+    for line in stderr.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, name = line.partition(':')[2].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+async def handle_stub(reader, writer):
+    while line := await reader.readline():
+        request = json.loads(line)
+        writer.write(json.dumps({'id': request.get('id'), 'type': 'data', 'data': True, 'complete': True}).encode('utf8') + b'\n')
+        await writer.drain()
+    writer.close()
+
+async def wall_times(repeat, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await run(sys.executable, *args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def summary(times):
+    return {
+        'min_ms': min(times) * 1000,
+        'median_ms': statistics.median(times) * 1000,
+        'max_ms': max(times) * 1000,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=20)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--check', action='store_true', help='Fail if modules that should be lazy are imported')
+    args = parser.parse_args()
+
+    times = await import_times()
+    eager = [m for m in LAZY_MODULES if m in times]
+
+    with tempfile.TemporaryDirectory() as dir:
+        server = await asyncio.start_unix_server(handle_stub, os.path.join(dir, 'ffcli.sock'))
+        async with server:
+            # python itself, for reference
+            python = await wall_times(args.repeat, '-c', 'pass')
+            status = await wall_times(args.repeat, FFCLI, '-P', dir, 'do', 'status')
+
+    result = {
+        'import_ffcli_ms': times['ffcli'] / 1000,
+        'eager_imports': eager,
+        'python': summary(python),
+        'do_status': summary(status),
+    }
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f'import ffcli: {result["import_ffcli_ms"]:.1f}ms')
+        slowest = sorted(((v, k) for k, v in times.items() if k != 'ffcli'), reverse=True)[:10]
+        for us, name in slowest:
+            print(f'    {us / 1000:6.1f}ms {name}')
+        for name in ('python', 'do_status'):
+            print(f'{name}: ' + ', '.join(f'{k} {v:.1f}' for k, v in result[name].items()))
+        if eager:
+            print('imported eagerly:', ', '.join(eager))
+
+    if args.check and eager:
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# end to end benchmarks of ffcli.Client -> ffcli-server -> a stand-in extension, no browser needed
+#
+# each scenario runs with --clients Clients at once, each with its own connection:
+#   status:    small calls, --in-flight at a time per client, latency is per call
+#   fetch:     --fetches streamed fetch bodies of --size bytes per client, latency is per fetch
+#   subscribe: one subscription of --events events per client, latency is per subscription
+# for each it reports messages/sec and MB/sec as seen by the clients, p50/p99 latency
+# and the peak rss of ffcli-server
+#
+# with --json the results are printed one json object per scenario, to compare runs
+# to compare against an older server or client:
+#   git show REV:ffcli-server > /tmp/ffcli-server.old
+#   bench/suite.py --server /tmp/ffcli-server.old
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ffcli
+from fake_extension import FakeExtension, DEFAULT_SERVER, EVENT
+
+SCENARIOS = ('status', 'fetch', 'subscribe')
+
+async def workers(count, fn):
+    # runs fn() until it returns False, count at a time
+    async def worker():
+        while await fn():
+            pass
+    await asyncio.gather(*(worker() for _ in range(count)))
+
+async def run_status(client, args, latencies):
+    remaining = iter(range(args.calls))
+
+    async def call():
+        if next(remaining, None) is None:
+            return False
+        start = time.perf_counter()
+        await client.status()
+        latencies.append(time.perf_counter() - start)
+        return True
+
+    await workers(args.in_flight, call)
+    return args.calls, 0
+
+async def run_fetch(client, args, latencies):
+    remaining = iter(range(args.fetches))
+    messages = size = 0
+
+    async def fetch():
+        nonlocal messages, size
+        if next(remaining, None) is None:
+            return False
+        start = time.perf_counter()
+        async for data in client.fetch(f'bench://{args.size}').read():
+            messages += 1
+            size += len(data)
+        latencies.append(time.perf_counter() - start)
+        return True
+
+    await workers(args.in_flight, fetch)
+    return messages, size
+
+async def run_subscribe(client, args, latencies):
+    start = time.perf_counter()
+    count = 0
+    async for _ in client.subscribe('bench.event', args.events).events():
+        count += 1
+    latencies.append(time.perf_counter() - start)
+    # roughly what each event costs on the wire
+    return count, count * len(json.dumps([EVENT]))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+async def run_scenario(ext, name, args):
+    run = globals()['run_' + name]
+    latencies = []
+    async with contextlib.AsyncExitStack() as stack:
+        clients = [await stack.enter_async_context(ffcli.Client(ext.profile_dir)) for _ in range(args.clients)]
+        # warm up, e.g. the __binary__ request
+        await asyncio.gather(*(c.status() for c in clients))
+
+        peak = ext.rss()
+        start = time.perf_counter()
+        task = asyncio.gather(*(run(c, args, latencies) for c in clients))
+        while not task.done():
+            peak = max(peak, ext.rss())
+            await asyncio.wait([task], timeout=0.05)
+        elapsed = time.perf_counter() - start
+        results = task.result()
+
+    messages = sum(m for m, _ in results)
+    size = sum(s for _, s in results)
+    return dict(
+        scenario=name,
+        clients=args.clients,
+        messages_per_sec=messages / elapsed,
+        mb_per_sec=size / elapsed / 2**20,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        relay_rss_mb=peak / 2**20,
+    )
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f'Any of {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--legacy', action='store_true', help='Send replies without the routing header, for older servers')
+    parser.add_argument('-c', '--clients', type=int, default=4)
+    parser.add_argument('--in-flight', type=int, default=16, help='Calls or fetches each client runs at once')
+    parser.add_argument('--calls', type=int, default=5000, help='status calls per client')
+    parser.add_argument('--fetches', type=int, default=20, help='Fetches per client')
+    parser.add_argument('--size', type=int, default=2**22, help='Size of each fetch body')
+    parser.add_argument('--events', type=int, default=50000, help='Events per subscription')
+    parser.add_argument('--json', action='store_true', help='Print the results as json, one object per scenario')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'invalid scenario: {name}')
+    args.scenarios = args.scenarios or SCENARIOS
+
+    if not args.json:
+        print(f'{"scenario":<10} {"clients":>7} {"msg/s":>9} {"MB/s":>8} {"p50":>9} {"p99":>9} {"relay rss":>10}')
+    for name in args.scenarios:
+        # a fresh server each time so that the rss of one scenario does not carry over
+        async with FakeExtension(args.server, legacy=args.legacy) as ext:
+            result = await run_scenario(ext, name, args)
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print(f'{name:<10} {result["clients"]:>7} {result["messages_per_sec"]:>9.0f} {result["mb_per_sec"]:>8.1f} {result["p50_ms"]:>7.2f}ms {result["p99_ms"]:>7.2f}ms {result["relay_rss_mb"]:>8.1f}MB', flush=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
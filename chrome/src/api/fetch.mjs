@@ -1,7 +1,7 @@
 import { browser } from '../browser.mjs';
 import { hasPermission } from '../permissions.mjs';
 import { call_function, resolve_function, executeInTab } from './index.mjs';
-import { send } from '../shared.mjs';
+import { send, signal } from '../shared.mjs';
 
 const fetch_tabs = {};
 
@@ -24,10 +24,17 @@ async function run_fetch(msg, url, opts, send) {
     });
 
     const body = resp.body?.getReader();
+    let ready = true;
     while (body) {
         const chunk = await body.read();
         if (chunk.done) { break; };
-        send(msg, {type: 'responseBody', data: btoa(String.fromCharCode.apply(null, chunk.value))});
+        // ffcli-server holds this back while the client is reading slowly
+        // the next chunk is read while waiting so it costs no extra round trip otherwise
+        if (await ready === false) {
+            await body.cancel();
+            break;
+        }
+        ready = send(msg, {type: 'responseBody', data: btoa(String.fromCharCode.apply(null, chunk.value))});
     }
 };
 
@@ -149,6 +156,8 @@ export async function browser_fetch(url, opts={}) {
         }
 
     } else {
+        // the fetch in a tab stops when send() tells it to instead, since this cannot be passed to it
+        opts.signal = signal(this);
         await webRequestWrapper(url, opts, {tabId: -1}, async (url, opts) => {
             await run_fetch(this, url, opts, send);
         });
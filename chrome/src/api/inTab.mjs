@@ -1,208 +1,269 @@
 import { browser } from '../browser.mjs';
 import { executeInTab } from './index.mjs';
+import { signal } from '../shared.mjs';
 
-export async function executeApi(msg, fn, tabId, opts, ...args) {
-    return executeInTab(tabId, opts, [msg, tabId, fn, args], async (msg, tabId, fn, args) => {
+// the half of executeApi that runs in the page
+// it is injected once per document and stays there as an agent that answers later calls sent with tabs.sendMessage
+async function agent(msg, tabId, fn, args) {
+    if (window.ffcliAgent) {
+        return window.ffcliAgent(msg, fn, args);
+    }
 
-        window.nodes ??= {
-            map: new WeakMap(),
-            ref_map: new Map(),
 
-            get_ref(obj) {
-                return window.nodes.map.get(obj);
-            },
-            set_ref(obj) {
-                let ref = window.nodes.get_ref(obj);
-                if (!ref) {
-                    ref = Math.random().toString();
-                    window.nodes.map.set(obj, ref);
-                    window.nodes.ref_map.set(ref, new WeakRef(obj));
-                }
-                return ref;
-            },
-            get_obj(ref) {
-                const weak_ref = window.nodes.ref_map.get(ref);
-                if (weak_ref) {
-                    const strong_ref = weak_ref.deref();
-                    if (!strong_ref) {
-                        window.nodes.ref_map.delete(ref);
-                    }
-                    return strong_ref;
+    window.nodes ??= {
+        map: new WeakMap(),
+        ref_map: new Map(),
+
+        get_ref(obj) {
+            return window.nodes.map.get(obj);
+        },
+        set_ref(obj) {
+            let ref = window.nodes.get_ref(obj);
+            if (!ref) {
+                ref = Math.random().toString();
+                window.nodes.map.set(obj, ref);
+                window.nodes.ref_map.set(ref, new WeakRef(obj));
+            }
+            return ref;
+        },
+        get_obj(ref) {
+            const weak_ref = window.nodes.ref_map.get(ref);
+            if (weak_ref) {
+                const strong_ref = weak_ref.deref();
+                if (!strong_ref) {
+                    window.nodes.ref_map.delete(ref);
                 }
-            },
-        };
+                return strong_ref;
+            }
+        },
+    };
 
-        function getNodes(path, filter) {
-            let nodes = [];
-            try {
-                filter = filter ?? {};
-                if (!filter.url || window.location.href === filter.url) {
-                    if (filter.ref && !path && !filter.parent) {
-                        let node = window.nodes.get_obj(filter.ref);
-                        if (node) {
-                            nodes = [node];
-                        }
-                    } else {
-                        let parent = document;
-                        if (filter.parent) {
-                            parent = window.nodes.get_obj(filter.parent)
-                        }
+    function getNodes(path, filter) {
+        let nodes = [];
+        try {
+            filter = filter ?? {};
+            if (!filter.url || window.location.href === filter.url) {
+                if (filter.ref && !path && !filter.parent) {
+                    let node = window.nodes.get_obj(filter.ref);
+                    if (node) {
+                        nodes = [node];
+                    }
+                } else {
+                    let parent = document;
+                    if (filter.parent) {
+                        parent = window.nodes.get_obj(filter.parent)
+                    }
 
-                        nodes = Array.from(parent ? parent.querySelectorAll(path) : []);
+                    nodes = Array.from(parent ? parent.querySelectorAll(path) : []);
 
-                        if (filter.ref) {
-                            nodes = nodes.filter(x => window.nodes.get_ref(x) == filter.ref);
-                        }
+                    if (filter.ref) {
+                        nodes = nodes.filter(x => window.nodes.get_ref(x) == filter.ref);
                     }
                 }
-                return nodes;
-            } catch(e) {
-                throw new Error(e)
             }
+            return nodes;
+        } catch(e) {
+            throw new Error(e)
         }
+    }
 
-        function prepare_for_serialization(value, node) {
-            if (typeof value === 'function') {
-                return value.bind(node)();
-            } else if (value instanceof CSSStyleDeclaration) {
-                const result = {};
-                for (const prop of value) {
-                    result[prop] = value[prop];
-                }
-                return result;
-            } else {
-                return value;
+    function isVisible(node) {
+        if (node.checkVisibility) {
+            return node.checkVisibility({checkOpacity: true, checkVisibilityCSS: true});
+        }
+        return node.getClientRects().length > 0;
+    }
+
+    function prepare_for_serialization(value, node) {
+        if (typeof value === 'function') {
+            return value.bind(node)();
+        } else if (value instanceof CSSStyleDeclaration) {
+            const result = {};
+            for (const prop of value) {
+                result[prop] = value[prop];
             }
+            return result;
+        } else {
+            return value;
         }
+    }
+
+    function getNodeValues(nodes, keys, manyKeys) {
+        return nodes.map(n => {
+            const values = keys.map(k => {
+                let value = k ? n[k] : n;
+                if (typeof value === 'undefined' && k === 'getComputedStyle') {
+                    value = window.getComputedStyle(n);
+                }
+                value = prepare_for_serialization(value, n);
 
-        function getNodeValues(nodes, keys, manyKeys) {
-            return nodes.map(n => {
-                const values = keys.map(k => {
-                    let value = k ? n[k] : n;
-                    if (typeof value === 'undefined' && k === 'getComputedStyle') {
-                        value = window.getComputedStyle(n);
+                if (value instanceof HTMLElement || value instanceof SVGElement || value instanceof HTMLDocument) {
+                    // make some refs
+                    value = window.nodes.set_ref(value);
+                }
+                return value;
+            });
+            return manyKeys ? values : values[0];
+        });
+    }
+
+    const table = {
+        userAgent() { return window.navigator.userAgent; },
+
+        localStorage: {
+            length(...args) { return window.localStorage.length; },
+            key(...args) { return window.localStorage.key(...args); },
+            getItem(...args) { return window.localStorage.getItem(...args); },
+            setItem(...args) { return window.localStorage.setItem(...args); },
+            removeItem(...args) { return window.localStorage.removeItem(...args); },
+            clear(...args) { return window.localStorage.clear(...args); },
+            getAll(...args) { return window.localStorage; },
+        },
+
+        dom: {
+
+            get(path, keys, ...args) {
+                const nodes = getNodes(path, ...args);
+                const manyKeys = Array.isArray(keys);
+                if (!manyKeys) {
+                    keys = [keys];
+                }
+                return getNodeValues(nodes, keys, manyKeys);
+            },
+
+            shadowRootGet(path, shadowSelector, keys, ...args) {
+                const nodes = [];
+                for (const n of getNodes(path, ...args)) {
+                    if (n.shadowRoot) {
+                        nodes.push(...n.shadowRoot.querySelectorAll(shadowSelector));
                     }
-                    value = prepare_for_serialization(value, n);
+                }
+                const manyKeys = Array.isArray(keys);
+                if (!manyKeys) {
+                    keys = [keys];
+                }
+                return getNodeValues(nodes, keys, manyKeys);
+            },
+
+            count(...args) {
+                return getNodes(...args).length;
+            },
 
+            set(path, key, value, ...args) {
+                const nodes = getNodes(path, ...args);
+                for (const node of nodes) {
+                    node[key] = value;
+                }
+                return nodes.length;
+            },
+
+            call(path, key, fnArgs, ...args) {
+                const nodes = getNodes(path, ...args);
+                return nodes.map(x => {
+                    let value = x[key](...(fnArgs || []));
                     if (value instanceof HTMLElement || value instanceof SVGElement || value instanceof HTMLDocument) {
                         // make some refs
                         value = window.nodes.set_ref(value);
                     }
                     return value;
                 });
-                return manyKeys ? values : values[0];
-            });
-        }
+            },
 
-        const table = {
-            userAgent() { return window.navigator.userAgent; },
-
-            localStorage: {
-                length(...args) { return window.localStorage.length; },
-                key(...args) { return window.localStorage.key(...args); },
-                getItem(...args) { return window.localStorage.getItem(...args); },
-                setItem(...args) { return window.localStorage.setItem(...args); },
-                removeItem(...args) { return window.localStorage.removeItem(...args); },
-                clear(...args) { return window.localStorage.clear(...args); },
-                getAll(...args) { return window.localStorage; },
+            getAttributes(...args) {
+                return getNodes(...args).map(x => {
+                    const attrs = {};
+                    for (const attr of x.attributes) {
+                        attrs[attr.name] = attr.value;
+                    }
+                    return attrs;
+                });
             },
 
-            dom: {
+            getComputedStyle(...args) {
+                return getNodes(...args).map(x => prepare_for_serialization(window.getComputedStyle(x)));
+            },
 
-                get(path, keys, ...args) {
-                    const nodes = getNodes(path, ...args);
-                    const manyKeys = Array.isArray(keys);
-                    if (!manyKeys) {
-                        keys = [keys];
-                    }
-                    return getNodeValues(nodes, keys, manyKeys);
-                },
-
-                shadowRootGet(path, shadowSelector, keys, ...args) {
-                    const nodes = [];
-                    for (const n of getNodes(path, ...args)) {
-                        if (n.shadowRoot) {
-                            nodes.push(...n.shadowRoot.querySelectorAll(shadowSelector));
-                        }
-                    }
-                    const manyKeys = Array.isArray(keys);
-                    if (!manyKeys) {
-                        keys = [keys];
+            sendKey(path, key, code, ...args) {
+                const props = {bubbles: true, composed: true, cancelable: true}
+                const charCode = code ?? key.charCodeAt(0);
+                const keyProps = {key, code: key, charCode, keyCode: charCode, which: charCode, ...props};
+                const nodes = args.length > 0 ? getNodes(path, ...args) : [document];
+                return nodes.map(x => {
+                    x.dispatchEvent(new FocusEvent('focus', props));
+                    x.dispatchEvent(new KeyboardEvent('keydown', keyProps));
+                    x.dispatchEvent(new KeyboardEvent('keyup', keyProps));
+                    x.dispatchEvent(new KeyboardEvent('keypress', keyProps));
+                    x.dispatchEvent(new KeyboardEvent('input', keyProps));
+                    x.dispatchEvent(new InputEvent('input', props));
+                    x.dispatchEvent(new InputEvent('change', props));
+                    x.dispatchEvent(new FocusEvent('blur', props));
+                });
+            },
+
+            dispatchEvent(path, type, options, cls, ...args) {
+                const nodes = getNodes(path, ...args);
+                const event_cls = window[`${cls ?? ''}Event`];
+                return nodes.map(x => {
+                    const event = new event_cls(type, options);
+                    return x.dispatchEvent(event);
+                });
+            },
+
+            // resolves true as soon as count nodes match, false after timeout ms
+            // or 'navigated' if the page goes away first
+            wait(path, {id, visible=false, count=1, timeout=0}, ...args) {
+                const matches = () => {
+                    let nodes = getNodes(path, ...args);
+                    if (visible) {
+                        nodes = nodes.filter(isVisible);
                     }
-                    return getNodeValues(nodes, keys, manyKeys);
-                },
+                    return nodes.length >= count;
+                };
+                if (matches()) {
+                    return true;
+                }
 
-                count(...args) {
-                    return getNodes(...args).length;
-                },
+                window.waits ??= new Map();
+                return new Promise(resolve => {
+                    const check = () => matches() && finish(true);
+                    const onPagehide = () => finish('navigated');
+                    // stylesheets, images and transitions can show a node without any mutation
+                    const events = visible ? ['load', 'transitionend', 'animationend'] : [];
 
-                set(path, key, value, ...args) {
-                    const nodes = getNodes(path, ...args);
-                    for (const node of nodes) {
-                        node[key] = value;
+                    const observer = new MutationObserver(check);
+                    observer.observe(document, {childList: true, subtree: true, attributes: true});
+                    const timer = timeout ? setTimeout(() => finish(false), timeout) : null;
+                    window.addEventListener('pagehide', onPagehide);
+                    for (const e of events) {
+                        window.addEventListener(e, check, true);
                     }
-                    return nodes.length;
-                },
-
-                call(path, key, fnArgs, ...args) {
-                    const nodes = getNodes(path, ...args);
-                    return nodes.map(x => {
-                        let value = x[key](...(fnArgs || []));
-                        if (value instanceof HTMLElement || value instanceof SVGElement || value instanceof HTMLDocument) {
-                            // make some refs
-                            value = window.nodes.set_ref(value);
-                        }
-                        return value;
-                    });
-                },
-
-                getAttributes(...args) {
-                    return getNodes(...args).map(x => {
-                        const attrs = {};
-                        for (const attr of x.attributes) {
-                            attrs[attr.name] = attr.value;
+                    window.waits.set(id, finish);
+
+                    function finish(value) {
+                        observer.disconnect();
+                        clearTimeout(timer);
+                        window.removeEventListener('pagehide', onPagehide);
+                        for (const e of events) {
+                            window.removeEventListener(e, check, true);
                         }
-                        return attrs;
-                    });
-                },
-
-                getComputedStyle(...args) {
-                    return getNodes(...args).map(x => prepare_for_serialization(window.getComputedStyle(x)));
-                },
-
-                sendKey(path, key, code, ...args) {
-                    const props = {bubbles: true, composed: true, cancelable: true}
-                    const charCode = code ?? key.charCodeAt(0);
-                    const keyProps = {key, code: key, charCode, keyCode: charCode, which: charCode, ...props};
-                    const nodes = args.length > 0 ? getNodes(path, ...args) : [document];
-                    return nodes.map(x => {
-                        x.dispatchEvent(new FocusEvent('focus', props));
-                        x.dispatchEvent(new KeyboardEvent('keydown', keyProps));
-                        x.dispatchEvent(new KeyboardEvent('keyup', keyProps));
-                        x.dispatchEvent(new KeyboardEvent('keypress', keyProps));
-                        x.dispatchEvent(new KeyboardEvent('input', keyProps));
-                        x.dispatchEvent(new InputEvent('input', props));
-                        x.dispatchEvent(new InputEvent('change', props));
-                        x.dispatchEvent(new FocusEvent('blur', props));
-                    });
-                },
-
-                dispatchEvent(path, type, options, cls, ...args) {
-                    const nodes = getNodes(path, ...args);
-                    const event_cls = window[`${cls ?? ''}Event`];
-                    return nodes.map(x => {
-                        const event = new event_cls(type, options);
-                        return x.dispatchEvent(event);
-                    });
-                },
+                        window.waits.delete(id);
+                        resolve(value);
+                    }
+                });
+            },
 
+            cancelWait(id) {
+                window.waits?.get(id)?.(false);
             },
-        };
 
-        function resolve_function(string) {
-            return (string || '').split('.').reduce((x, y) => x && x[y], table);
-        }
+        },
+    };
+
+    function resolve_function(string) {
+        return (string || '').split('.').reduce((x, y) => x && x[y], table);
+    }
 
+    async function call(msg, fn, args) {
         const func = resolve_function(fn);
         if (typeof func != 'function') {
             throw new Error(`no such function ${fn}`);
@@ -219,7 +280,87 @@ export async function executeApi(msg, fn, tabId, opts, ...args) {
         }
         return value;
     }
-)};
+
+    window.ffcliAgent = call;
+    (globalThis.browser ?? globalThis.chrome).runtime.onMessage.addListener((message, sender, sendResponse) => {
+        if (!message?.ffcliAgent) {
+            return;
+        }
+        call(...message.ffcliAgent).then(
+            result => sendResponse({result}),
+            e => sendResponse({error: {name: e?.name, message: e?.message ?? String(e)}}),
+        );
+        return true;
+    });
+
+    return call(msg, fn, args);
+}
+
+// tab id -> ids of the frames that have an agent
+// a tab forgets them when it starts loading a new page
+const agents = new Map();
+const agentStats = {calls: 0, injections: 0, stale: 0, fallbacks: 0};
+
+browser.tabs.onUpdated.addListener((tabId, changeInfo) => {
+    if (changeInfo.status == 'loading') {
+        agents.delete(tabId);
+    }
+});
+browser.tabs.onRemoved.addListener(tabId => agents.delete(tabId));
+
+async function callAgent(msg, fn, tabId, frameId, args) {
+    // returns undefined if there is no agent to take the call
+    let response;
+    try {
+        response = await browser.tabs.sendMessage(tabId, {ffcliAgent: [msg, fn, args]}, {frameId});
+    } catch(e) {
+        if (!String(e?.message).includes('Receiving end does not exist')) {
+            throw e;
+        }
+    }
+    if (!response) {
+        // e.g. a frame navigated by itself
+        agents.get(tabId)?.delete(frameId);
+        agentStats.stale += 1;
+        return;
+    }
+
+    agentStats.calls += 1;
+    if (response.error) {
+        throw Object.assign(new Error(response.error.message), {name: response.error.name});
+    }
+    // the same shape that executeInTab gives for one frame
+    return {value: Array.isArray(response.result) ? response.result : [response.result]};
+}
+
+export async function executeApi(msg, fn, tabId, opts, ...args) {
+    const target = opts?.target ?? {};
+    if (target.allFrames || target.documentIds || (target.frameIds?.length ?? 1) != 1) {
+        // many frames at once, inject into each of them instead
+        agentStats.fallbacks += 1;
+        return executeInTab(tabId, opts, [msg, tabId, fn, args], agent);
+    }
+
+    if (tabId == 0) {
+        tabId = (await browser.tabs.query({active: true, currentWindow: true}))[0].id;
+    }
+    const frameId = target.frameIds?.[0] ?? 0;
+    if (agents.get(tabId)?.has(frameId)) {
+        const result = await callAgent(msg, fn, tabId, frameId, args);
+        if (result) {
+            return result.value;
+        }
+    }
+
+    // this installs the agent and makes the call in one go
+    agentStats.injections += 1;
+    const result = await executeInTab(tabId, opts, [msg, tabId, fn, args], agent);
+    if (!agents.has(tabId)) {
+        agents.set(tabId, new Set());
+    }
+    agents.get(tabId).add(frameId);
+    return result;
+}
 
 function makeApi(fn, numArgs) {
     return function(...args) {
@@ -236,6 +377,14 @@ export const api = {
         return executeApi(this, 'userAgent', tabId, opts)
     },
 
+    agentStats() {
+        let frames = 0;
+        for (const ids of agents.values()) {
+            frames += ids.size;
+        }
+        return {...agentStats, tabs: agents.size, frames};
+    },
+
     localStorage: {
         length: makeApi('localStorage.length', 0),
         key: makeApi('localStorage.key', 1),
@@ -250,15 +399,46 @@ export const api = {
         async check(...args) {
             return await api.dom.count(...args) > 0;
         },
-        async wait(path, {timeout=0, ...args}={}) {
-            const interval = 500;
-            for (let elapsed = 0; !timeout || elapsed < timeout; elapsed += interval) {
-                if (await api.dom.check(path, args)) {
-                    return true;
+        async wait(path, {timeout=0, visible=false, count=1, tabId=0, target=null, ...filter}={}) {
+            // the page itself watches for the node, so each wait is usually a single injection
+            if (tabId == 0) {
+                tabId = (await browser.tabs.query({active: true, currentWindow: true}))[0].id;
+            }
+            const id = crypto.randomUUID();
+            const deadline = Date.now() + timeout;
+            const cancel = () => executeApi(this, 'dom.cancelWait', tabId, {target}, id).catch(() => {});
+            signal(this)?.addEventListener('abort', cancel);
+
+            try {
+                let navigated = false;
+                while (true) {
+                    signal(this)?.throwIfAborted();
+                    const remaining = deadline - Date.now();
+                    if (timeout && remaining <= 0) {
+                        return false;
+                    }
+
+                    let result;
+                    try {
+                        result = await executeApi(this, 'dom.wait', tabId, {target}, path, {id, visible, count, timeout: timeout && remaining}, filter);
+                    } catch(e) {
+                        if (!navigated) {
+                            throw e;
+                        }
+                        // the next page may not take scripts yet
+                        await new Promise(resolve => setTimeout(resolve, 50));
+                        continue;
+                    }
+
+                    // try again on the next page
+                    navigated = result?.includes('navigated') ?? false;
+                    if (!navigated) {
+                        return result?.includes(true) ?? false;
+                    }
                 }
-                await new Promise(resolve => setTimeout(resolve, interval));
+            } finally {
+                signal(this)?.removeEventListener('abort', cancel);
             }
-            return false;
         },
     },
 };
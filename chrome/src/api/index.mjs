@@ -3,7 +3,7 @@ import { customPermissions, hasPermission } from '../permissions.mjs';
 import { browser_fetch } from './fetch.mjs';
 import { api as inTabApi } from './inTab.mjs';
 import { api as subscribeApi } from './subscribe.mjs';
-import { send } from '../shared.mjs';
+import { send, serializable, errorData } from '../shared.mjs';
 
 async function _resolve_function(string) {
     const fn = (string || '').split('.');
@@ -85,4 +85,22 @@ const api = {
     },
 
     fetch: browser_fetch,
+
+    async batch(calls) {
+        // run many calls from a single message
+        // each call succeeds or fails on its own
+        return await Promise.all((calls || []).map(async ({fn, args}) => {
+            try {
+                if (unbatchable.has(fn)) {
+                    throw new Error(`cannot batch ${fn}`);
+                }
+                return {type: 'data', data: serializable(await call_function.bind(this)(fn, ...(args || [])))};
+            } catch(e) {
+                return {type: 'error', data: errorData(e)};
+            }
+        }));
+    },
 };
+
+// these stream data back, which cannot be told apart inside a batch
+const unbatchable = new Set(['batch', 'subscribe', 'fetch']);
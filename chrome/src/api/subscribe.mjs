@@ -1,7 +1,64 @@
 import { browser } from '../browser.mjs';
-import { send, subscribers } from '../shared.mjs';
+import { send, subscribers, signal } from '../shared.mjs';
 import { resolve_function} from './index.mjs';
 
+// paths are dotted, into the list of listener arguments, e.g. 0.url or 2.status
+function getPath(value, path) {
+    for (const key of String(path).split('.')) {
+        if (value === null || value === undefined) {
+            return undefined;
+        }
+        value = value[key];
+    }
+    return value;
+}
+
+function setPath(target, path, value) {
+    const keys = String(path).split('.');
+    for (let i = 0; i < keys.length - 1; i++) {
+        target = target[keys[i]] ??= (/^\d+$/.test(keys[i+1]) ? [] : {});
+    }
+    target[keys.at(-1)] = value;
+}
+
+// keeps only the given paths, in the same shape as the original
+function project(args, fields) {
+    const result = [];
+    for (const path of fields) {
+        const value = getPath(args, path);
+        if (value !== undefined) {
+            setPath(result, path, value);
+        }
+    }
+    return result;
+}
+
+const OPERATORS = {
+    '==': (a, b) => JSON.stringify(a) === JSON.stringify(b),
+    '!=': (a, b) => JSON.stringify(a) !== JSON.stringify(b),
+    '<': (a, b) => a < b,
+    '<=': (a, b) => a <= b,
+    '>': (a, b) => a > b,
+    '>=': (a, b) => a >= b,
+    '~': (a, b) => typeof a == 'string' && b.test(a),
+    'in': (a, b) => Array.isArray(b) && b.some(x => OPERATORS['=='](a, x)),
+    'exists': (a, b) => (a !== undefined && a !== null) == (b ?? true),
+};
+
+// where is a list of [path, operator, value], all of which must hold
+function compile(where) {
+    const conditions = where.map(([path, op, value]) => {
+        if (!OPERATORS[op]) {
+            throw new Error(`no such operator ${op}`);
+        }
+        if (op == '~') {
+            value = new RegExp(value);
+        }
+        return args => OPERATORS[op](getPath(args, path), value);
+    });
+    return args => conditions.every(c => c(args));
+}
+
 export const api = {
     async subscribe(event, numEvents=null, ...args) {
         if (numEvents === null) {
@@ -13,6 +70,12 @@ export const api = {
             throw new Error(`no such event ${event}`);
         }
 
+        // fields and where are options of the request rather than arguments to the listener
+        const { fields, where } = this;
+        delete this.fields;
+        delete this.where;
+        const matches = where ? compile(where) : null;
+
         const subscriptionId = crypto.randomUUID();
         if (!subscribers[this._id]) {
             subscribers[this._id] = {}
@@ -23,24 +86,28 @@ export const api = {
         send(this, {subscriptionId})
 
         const listener = (...args) => {
+            if (matches && !matches(args)) {
+                return;
+            }
             if (numEvents == 1) {
                 api.unsubscribe.bind(this)(subscriptionId);
             }
             if (numEvents > 0) {
                 numEvents -= 1;
-                send(this, args);
+                send(this, fields ? project(args, fields) : args);
             }
         }
         ev.addListener(listener, ...args);
+        signal(this)?.addEventListener('abort', () => api.unsubscribe.bind(this)(subscriptionId));
         await promise;
         ev.removeListener(listener);
     },
 
     unsubscribe(subid) {
         const subs = subscribers[this._id];
-        if (subs[subid]) {
+        if (subs?.[subid]) {
             subs[subid](); // resolves
         }
-        delete subs[subid];
+        delete subs?.[subid];
     },
 }
@@ -1,8 +1,14 @@
 import { browser } from './browser.mjs';
 import { call_function } from './api/index.mjs';
-import { port, subscribers } from './shared.mjs';
+import { port, subscribers, paused, running, reply, pause, resume, cancel, flowControl, startRequest, endRequest, abortable, serializable, errorData } from './shared.mjs';
 
-browser.runtime.onMessage.addListener(port.postMessage);
+// replies from code running in tabs
+// they are answered once ffcli-server is ready for more from the same request
+browser.runtime.onMessage.addListener((msg, sender, sendResponse) => {
+    reply(msg);
+    flowControl(msg).then(sendResponse);
+    return true;
+});
 // handshake
 (async function() {
     let id = (await browser.storage.local.get('ffcliId')).ffcliId;
@@ -36,6 +42,24 @@ port.onMessage.addListener((msg) => {
             }
             delete subscribers[msg._id];
         }
+        // nobody is left to read the results of anything still running
+        for (const id of new Set([...(running[msg._id]?.keys() ?? []), ...(paused[msg._id]?.keys() ?? [])])) {
+            cancel(msg._id, id);
+        }
+        return;
+    }
+
+    if (msg.type == 'cancel') {
+        cancel(msg._id, msg.id);
+        return;
+    }
+
+    if (msg.type == 'pause') {
+        pause(msg._id, msg.id);
+        return;
+    }
+    if (msg.type == 'resume') {
+        resume(msg._id, msg.id);
         return;
     }
 
@@ -44,26 +68,19 @@ port.onMessage.addListener((msg) => {
         delete msg.fn;
         delete msg.args;
         delete msg.complete;
+        const controller = startRequest(msg);
+        delete msg.timeout;
         try {
-            let value = await call_function.bind(msg)(fn, ...(args || []));
-            if (value && !JSON.stringify(value)) {
-                value = `[${typeof value}]`;
-            }
+            const value = serializable(await abortable(call_function.bind(msg)(fn, ...(args || [])), controller.signal));
             msg.type = 'data';
-            msg.data = value ?? null;
+            msg.data = value;
         } catch(e) {
             msg.type = 'error';
-            msg.data = {error: e.toString()};
-            if (e.stack) {
-                msg.data.stack = e.stack.trim().split('\n');
-            } else if (e.fileName && e.lineNumber) {
-                msg.data.stack = [`${e.fileName}:${e.lineNumber}`];
-            } else if (e.fileName) {
-                msg.data.stack = [e.fileName];
-            }
+            msg.data = errorData(e);
         } finally {
+            endRequest(msg);
             msg.complete = true;
-            port.postMessage(msg);
+            reply(msg);
         }
     })();
 
@@ -2,11 +2,115 @@ import { browser } from './browser.mjs';
 
 export const port = browser.runtime.connectNative("ffcli");
 export const subscribers = {};
+// requests ffcli-server has asked to pause because their client is reading slowly
+// _id -> Map of id -> {promise, resolve}
+export const paused = {};
+// requests being run, so that they can be cancelled
+// _id -> Map of id -> AbortController
+export const running = {};
 
 export function sleep(timeout) {
     return new Promise(resolve => setTimeout(resolve, timeout))
 }
 
+// ffcli-server routes replies using the _h header without parsing the rest of the message
+// so it must be the first key
+export function reply(msg) {
+    const {_id, _h, ...rest} = msg;
+    return port.postMessage({_h: [_id, rest.complete ?? false, rest.id ?? null], ...rest});
+}
+
 export function send(msg, data) {
-    return port.postMessage({...msg, type: 'data', data});
+    reply({...msg, type: 'data', data});
+    return flowControl(msg);
+}
+
+export function pause(_id, id) {
+    const requests = paused[_id] ??= new Map();
+    if (!requests.has(id)) {
+        let resolve;
+        const promise = new Promise(r => { resolve = r; });
+        requests.set(id, {promise, resolve});
+    }
+}
+
+// value is false if the request should stop altogether, e.g. the client has gone
+export function resume(_id, id, value=true) {
+    const requests = paused[_id];
+    requests?.get(id)?.resolve(value);
+    requests?.delete(id);
+    if (requests?.size === 0) {
+        delete paused[_id];
+    }
+}
+
+// resolves to true once the request may send more, or false if it should stop
+// streams that can wait, e.g. fetch, should await this between messages
+export function flowControl(msg) {
+    if (signal(msg)?.aborted) {
+        return Promise.resolve(false);
+    }
+    return paused[msg._id]?.get(msg.id)?.promise ?? Promise.resolve(true);
+}
+
+// make sure a value can be sent over the port
+export function serializable(value) {
+    if (value && !JSON.stringify(value)) {
+        return `[${typeof value}]`;
+    }
+    return value ?? null;
+}
+
+export function startRequest(msg) {
+    const controller = new AbortController();
+    if (msg.timeout) {
+        // a deadline in seconds from the client
+        controller.timer = setTimeout(() => controller.abort(new Error(`timed out after ${msg.timeout}s`)), msg.timeout * 1000);
+    }
+    (running[msg._id] ??= new Map()).set(msg.id, controller);
+    return controller;
+}
+
+export function endRequest(msg) {
+    const requests = running[msg._id];
+    clearTimeout(requests?.get(msg.id)?.timer);
+    requests?.delete(msg.id);
+    if (requests?.size === 0) {
+        delete running[msg._id];
+    }
+}
+
+export function cancel(_id, id) {
+    running[_id]?.get(id)?.abort(new Error('cancelled'));
+    resume(_id, id, false);
+}
+
+// aborted once the client cancels the request or its deadline passes
+// long running functions should stop when it does, e.g. fetch passes it on
+export function signal(msg) {
+    return running[msg._id]?.get(msg.id)?.signal;
+}
+
+// settles as soon as the signal aborts, even if the call itself carries on
+export function abortable(promise, signal) {
+    return new Promise((resolve, reject) => {
+        const onAbort = () => reject(signal.reason);
+        if (signal.aborted) {
+            return onAbort();
+        }
+        signal.addEventListener('abort', onAbort, {once: true});
+        promise.then(resolve, reject).finally(() => signal.removeEventListener('abort', onAbort));
+    });
+}
+
+export function errorData(e) {
+    const data = {error: e.toString()};
+    if (e.stack) {
+        data.stack = e.stack.trim().split('\n');
+    } else if (e.fileName && e.lineNumber) {
+        data.stack = [`${e.fileName}:${e.lineNumber}`];
+    } else if (e.fileName) {
+        data.stack = [e.fileName];
+    }
+    return data;
 }
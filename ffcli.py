@@ -1,20 +1,12 @@
 #!/usr/bin/env python3
 
 import sys
-import csv
 import re
 import time
-import ssl
-import subprocess
-import email.utils
-from types import SimpleNamespace
+import math
+import collections
+import contextlib
 from functools import partial
-import fcntl
-import urllib.request
-import urllib.error
-import http.cookies
-import http.cookiejar
-import configparser
 import os
 import argparse
 import asyncio
@@ -22,8 +14,13 @@ import json
 import logging
 import socket
 import base64
+import struct
+import zlib
 import warnings
 
+# heavier modules are imported where they are used so that simple commands start quickly
+# see bench/startup.py
+
 class Error(Exception):
     def __str__(self):
         return 'Error: ' + json.dumps(self.args[0], indent=2)
@@ -39,6 +36,19 @@ def parse_json_object(data):
         return
     return data
 
+async def read_line(reader):
+    # like reader.readline(), but lines may be longer than the limit of the reader, e.g. screenshots
+    parts = []
+    while True:
+        try:
+            parts.append(await reader.readuntil(b'\n'))
+        except asyncio.LimitOverrunError as e:
+            parts.append(await reader.readexactly(e.consumed))
+            continue
+        except asyncio.IncompleteReadError as e:
+            parts.append(e.partial)
+        return b''.join(parts)
+
 def parse_maybe_json(data):
     try:
         import ruamel.yaml
@@ -61,26 +71,195 @@ def parse_maybe_json(data):
             data = json.loads(data)
     return data
 
+def parse_props(items):
+    # KEY=VALUE arguments, e.g. to list tabs
+    props = dict(x.partition('=')[::2] for x in items)
+    return {k: parse_maybe_json(v) for k, v in props.items()}
+
+WHERE_EXPR = re.compile(r'(!?)([^\s=!<>~]+)(?:\s*(==|!=|<=|>=|<|>|~)|\s+(in)\s)?\s*(.*)', re.S)
+
+def parse_where(expr):
+    # PATH==VALUE, PATH!=VALUE, PATH<VALUE etc, PATH~REGEX, PATH in [VALUES], PATH (exists) or !PATH (does not exist)
+    if not (match := WHERE_EXPR.fullmatch(expr.strip())):
+        raise argparse.ArgumentTypeError(f'invalid condition: {expr}')
+    negate, path, op, in_op, value = match.groups()
+    op = op or in_op
+    if not op:
+        if value:
+            raise argparse.ArgumentTypeError(f'invalid condition: {expr}')
+        return [path, 'exists', not negate]
+    if negate:
+        raise argparse.ArgumentTypeError(f'invalid condition: {expr}')
+    return [path, op, value if op == '~' else parse_maybe_json(value)]
+
 def get_free_port():
     with socket.socket() as s:
         s.bind(("", 0))
         return s.getsockname()[1]
 
+class ReplyQueue(asyncio.Queue):
+    # replies for one request
+    # with maxsize set, overflow decides what happens once a slow consumer lets it fill up:
+    #   block: stop reading from the socket until there is room,
+    #          which holds up replies to every other request on the client too
+    #   drop_oldest, drop_newest: drop a queued or the incoming event
+    #   coalesce: an event replaces a queued one with the same key(data),
+    #             e.g. key=lambda args: args[0] keeps the latest tabs.onUpdated per tab id,
+    #             and blocks like above when there is nothing to replace
+    #   pause: ask ffcli-server to pause the stream in the browser until the consumer is down to half of maxsize,
+    #          without holding up anything else on the client,
+    #          only streams that can wait stop, e.g. fetch bodies, and replies already on their way are still queued
+    # only plain data replies are dropped or coalesced, never errors, the final reply
+    # or the first reply (for subscriptions, the one carrying the subscription id)
+    OVERFLOW = ('block', 'drop_oldest', 'drop_newest', 'coalesce', 'pause')
+
+    def __init__(self, maxsize=0, overflow='block', key=None):
+        if overflow not in self.OVERFLOW:
+            raise ValueError(f'overflow must be one of {", ".join(self.OVERFLOW)}, got {overflow!r}')
+        if overflow == 'coalesce' and key is None:
+            raise ValueError('overflow=coalesce needs a key')
+        unblocked = overflow in ('drop_oldest', 'drop_newest', 'pause')
+        # these policies never block so the limit is enforced here instead
+        super().__init__(0 if unblocked else maxsize)
+        self.limit = maxsize if unblocked else 0
+        self.overflow = overflow
+        self.key = key
+        self._first = None
+        # key -> queued reply, for coalescing
+        self._keys = {}
+        self.dropped = 0
+        self.coalesced = 0
+        # times the socket reader had to wait for the consumer
+        self.blocked = 0
+        # for overflow=pause, called with True to pause the stream and False to resume it, set by Client
+        self.flow = None
+        self.paused = False
+        # times the stream was paused
+        self.pauses = 0
+
+    def stats(self):
+        return dict(size=self.qsize(), dropped=self.dropped, coalesced=self.coalesced, blocked=self.blocked, pauses=self.pauses)
+
+    def _droppable(self, item):
+        return item is not None and item is not self._first and item.get('type') == 'data' and not item.get('complete')
+
+    def _key_of(self, item):
+        if self.key is None or not self._droppable(item):
+            return None
+        try:
+            return self.key(item.get('data'))
+        except Exception:
+            logging.exception('failed to get key for %r', item.get('data'))
+            return None
+
+    def _absorb(self, item):
+        # returns True if the item was dropped or merged into a queued one
+        if self._first is None:
+            self._first = item
+            return False
+
+        if self.overflow == 'coalesce':
+            if (key := self._key_of(item)) is not None and (queued := self._keys.get(key)) is not None:
+                queued.clear()
+                queued.update(item)
+                self.coalesced += 1
+                return True
+
+        elif self.overflow in ('drop_oldest', 'drop_newest') and self.limit and self.qsize() >= self.limit and self._droppable(item):
+            if self.overflow == 'drop_newest':
+                self.dropped += 1
+                return True
+            for i, queued in enumerate(self._queue):
+                if self._droppable(queued):
+                    del self._queue[i]
+                    self.task_done()
+                    self.dropped += 1
+                    break
+        return False
+
+    def _set_paused(self, paused):
+        if self.paused != paused:
+            self.paused = paused
+            self.pauses += paused
+            if self.flow:
+                self.flow(paused)
+
+    def _put(self, item):
+        super()._put(item)
+        if (key := self._key_of(item)) is not None:
+            self._keys[key] = item
+        if self.overflow == 'pause' and self.limit and self.qsize() >= self.limit:
+            self._set_paused(True)
+
+    def _get(self):
+        item = super()._get()
+        if self._keys and (key := self._key_of(item)) is not None and self._keys.get(key) is item:
+            del self._keys[key]
+        if self.paused and self.qsize() <= self.limit // 2:
+            self._set_paused(False)
+        return item
+
+    def put_nowait(self, item):
+        if not self._absorb(item):
+            super().put_nowait(item)
+
+    async def put(self, item):
+        if not self._absorb(item):
+            if self.full():
+                self.blocked += 1
+            await super().put(item)
+
 class Response:
-    def __init__(self, client, fn, args):
-        self.queue = None
-        self.task = asyncio.create_task(client._execute(fn, *args))
+    # timeout is a deadline in seconds for the whole call, the browser is told about it too
+    # the call is cancelled if it passes, or if the task waiting for it is cancelled or the response is dropped
+    # options are extra keys of the request, e.g. fields and where for subscribe
+    def __init__(self, client, fn, args, timeout=None, options=None, **queue_args):
+        self.client = client
+        self.queue = ReplyQueue(**queue_args)
+        # the id is given out now, so that a response dropped before it is even sent can still be cancelled
+        client._register(self.queue)
+        self.deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        self.task = asyncio.create_task(client._execute(fn, *args, queue=self.queue, timeout=timeout, options=options))
 
     async def get_queue(self):
-        self.queue = self.queue or await self.task
+        if self.task:
+            await self.task
         return self.queue
 
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    @property
+    def coalesced(self):
+        return self.queue.coalesced
+
     def get_one(self):
         return anext(aiter(self.iter()))
 
+    def cancel(self):
+        self.client.cancel(self.queue.id)
+        if self.task:
+            self.task.cancel()
+
+    def __del__(self):
+        # dropped before it finished
+        if self.client:
+            self.client.cancel(self.queue.id)
+
+    async def _next(self, queue):
+        try:
+            if self.deadline is None:
+                return await queue.get()
+            async with asyncio.timeout_at(self.deadline):
+                return await queue.get()
+        except (asyncio.CancelledError, TimeoutError):
+            self.cancel()
+            raise
+
     async def iter(self):
         queue = await self.get_queue()
-        while item := await queue.get():
+        while item := await self._next(queue):
             data = item.get('data')
             if item.get('type') == 'error':
                 raise Error(data)
@@ -112,7 +291,73 @@ class RequestBuilder:
     def __call__(self, *args, **kwargs):
         if kwargs:
             args += (kwargs,)
-        return Response(self.__client, self.__key, args)
+        return self.__client.request(self.__key, args)
+
+class BatchResponse(Response):
+    # resolved by Batch, so it has no request of its own to time out or cancel
+    def __init__(self, fn, args):
+        self.client = None
+        self.fn = fn
+        self.args = args
+        self.queue = ReplyQueue()
+        self.deadline = None
+        self.task = None
+
+    def resolve(self, result):
+        self.queue.put_nowait(result)
+        self.queue.put_nowait(None)
+
+class Batch:
+    def __init__(self, client, size=None, window=None):
+        self._client = client
+        self._size = size
+        # max chunks in flight at once
+        self._window = window and asyncio.Semaphore(window)
+        self._responses = []
+
+    def request(self, fn, args):
+        response = BatchResponse(fn, args)
+        self._responses.append(response)
+        return response
+
+    def make_request_builder(self, key):
+        return RequestBuilder(self, key)
+
+    def __getattr__(self, key):
+        return self.make_request_builder(key)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is None:
+            await self.send()
+
+    async def _send_chunk(self, responses):
+        calls = [{'fn': r.fn, 'args': r.args} for r in responses]
+        # every response must be resolved however this goes, or whatever awaits it hangs
+        try:
+            if self._window:
+                async with self._window:
+                    results = await self._client.request('batch', (calls,))
+            else:
+                results = await self._client.request('batch', (calls,))
+            if not isinstance(results, list) or len(results) != len(responses):
+                raise Error({'error': f'expected {len(responses)} results from batch, got {results!r:.100}'})
+        except BaseException as e:
+            # the whole batch failed
+            error = e.args[0] if isinstance(e, Error) else {'error': repr(e)}
+            results = [{'type': 'error', 'data': error}] * len(responses)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            for response, result in zip(responses, results):
+                response.resolve(result)
+
+    async def send(self):
+        responses, self._responses = self._responses, []
+        size = self._size or len(responses) or 1
+        await asyncio.gather(*(self._send_chunk(responses[i:i+size]) for i in range(0, len(responses), size)))
 
 class FetchWrapper:
     def __init__(self, stream):
@@ -167,8 +412,20 @@ class FetchWrapper:
             self.body.clear()
 
 class Subscription(Response):
-    def __init__(self, client, event, num_events=None, loop=None, **kwargs):
-        super().__init__(client, 'subscribe', (event, num_events, kwargs))
+    # maxsize, overflow and key bound how many events are buffered, see ReplyQueue
+    # fields and where are applied in the browser, so that unwanted events and data never leave it:
+    #   fields: paths into the event arguments to keep, e.g. ['2.url'], the rest are dropped
+    #   where: {path: value} or [(path, operator, value), ...] that every event must match
+    #     operators are ==, !=, <, <=, >, >=, ~ (regex search), in (a list) and exists (true or false)
+    def __init__(self, client, event, num_events=None, loop=None, maxsize=0, overflow='block', key=None, fields=None, where=None, **kwargs):
+        options = {}
+        if fields is not None:
+            options['fields'] = list(fields)
+        if where is not None:
+            if isinstance(where, dict):
+                where = [(k, '==', v) for k, v in where.items()]
+            options['where'] = [list(c) for c in where]
+        super().__init__(client, 'subscribe', (event, num_events, kwargs), options=options, maxsize=maxsize, overflow=overflow, key=key)
         self._id = None
         self._client = client
         self._loop = loop or asyncio.get_event_loop()
@@ -194,11 +451,527 @@ class Subscription(Response):
         if self._id is not None and not self._loop.is_closed():
             self._loop.call_soon(lambda client, id: asyncio.create_task(client.unsubscribe(id).get()), self._client, self._id)
 
+class CookieCache:
+    # cookies for each (store id, cookie domain), loaded in bulk once per store
+    # and kept up to date with browser.cookies.onChanged
+    def __init__(self, client, max_cookies=100000):
+        self._client = client
+        self.max_cookies = max_cookies
+        # (store id, domain) -> {(name, path, partition key): cookie}, in LRU order
+        self._domains = collections.OrderedDict()
+        # (store id, domain) that were dropped to save memory and must be refetched
+        self._evicted = set()
+        # store id -> future that resolves once the store is loaded
+        self._stores = {}
+        # store id -> changes that arrived while the store was loading
+        self._pending = {}
+        # the default store id is not known until we see one of its cookies
+        self._default_store = None
+        self._subscription = None
+        self._task = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return dict(size=self.size, domains=len(self._domains), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        self._subscription = self._task = None
+
+    @staticmethod
+    def _key(cookie):
+        return (cookie['name'], cookie['path'], json.dumps(cookie.get('partitionKey'), sort_keys=True))
+
+    def _add(self, store_id, cookie):
+        domain = self._domains.setdefault((store_id, cookie['domain']), {})
+        key = self._key(cookie)
+        if key not in domain:
+            self.size += 1
+        domain[key] = cookie
+
+    def _remove(self, store_id, cookie):
+        key = (store_id, cookie['domain'])
+        if (domain := self._domains.get(key)) and domain.pop(self._key(cookie), None):
+            self.size -= 1
+            if not domain:
+                del self._domains[key]
+
+    def _evict(self):
+        while self.size > self.max_cookies and self._domains:
+            key, domain = self._domains.popitem(last=False)
+            self.size -= len(domain)
+            self._evicted.add(key)
+            self.evictions += 1
+
+    def _on_changed(self, info):
+        cookie = info['cookie']
+        store_id = cookie['storeId']
+
+        if store_id not in self._stores and self._default_store is None and None in self._stores:
+            # this may be the default store, we can't tell
+            if None in self._pending:
+                self._pending[None].append(info)
+            else:
+                # forget it so that it gets loaded again
+                self._stores.pop(None)
+            return
+
+        if store_id in self._pending:
+            self._pending[store_id].append(info)
+        elif store_id in self._stores and (store_id, cookie['domain']) not in self._evicted:
+            if info['removed']:
+                self._remove(store_id, cookie)
+            else:
+                self._add(store_id, cookie)
+                self._evict()
+
+    async def _watch(self):
+        async for data in self._subscription.events():
+            for info in data:
+                self._on_changed(info)
+
+    async def _load_store(self, store_id):
+        if self._subscription is None:
+            self._subscription = self._client.subscribe('browser.cookies.onChanged')
+            # make sure we are listening before taking the snapshot
+            await self._subscription.id()
+            self._task = asyncio.ensure_future(self._watch())
+
+        pending = self._pending[store_id] = []
+        try:
+            cookies = await self._client.browser.cookies.getAll({'storeId': store_id, 'partitionKey': {}})
+        finally:
+            self._pending.pop(store_id)
+
+        if store_id is None:
+            self._stores.pop(None)
+            if not cookies:
+                # nothing to learn the id from
+                # call it empty, unless something changed in the meantime
+                if not pending:
+                    self._stores[None] = True
+                return
+            store_id = self._default_store = cookies[0]['storeId']
+
+        self._stores[store_id] = True
+        for cookie in cookies:
+            self._add(store_id, cookie)
+        # changes since the snapshot
+        for info in pending:
+            self._on_changed(info)
+        self._evict()
+
+    async def _load_domain(self, store_id, domain):
+        self._evicted.discard((store_id, domain))
+        cookies = await self._client.browser.cookies.getAll({'storeId': store_id, 'domain': domain.lstrip('.'), 'partitionKey': {}})
+        for cookie in cookies:
+            # getAll also returns cookies for subdomains
+            if cookie['domain'] == domain:
+                self._add(store_id, cookie)
+        self._evict()
+
+    async def get(self, url, store_id=None, partitioned=False):
+        # returns the cookies that would be sent to url, like browser.cookies.getAll({url: ...})
+        import urllib.parse
+        url = urllib.parse.urlsplit(url)
+        host = (url.hostname or '').rstrip('.')
+        path = url.path or '/'
+        secure = url.scheme in ('https', 'wss')
+
+        hit = True
+        store_id = store_id or self._default_store
+        while (loaded := self._stores.get(store_id)) is not True:
+            if loaded is None:
+                hit = False
+                loaded = self._stores[store_id] = asyncio.ensure_future(self._load_store(store_id))
+            try:
+                await loaded
+            except BaseException:
+                if self._stores.get(store_id) is loaded:
+                    self._stores.pop(store_id)
+                raise
+            store_id = store_id or self._default_store
+
+        # the host itself for host-only cookies, then every parent domain
+        parts = host.split('.')
+        domains = [host] + ['.' + '.'.join(parts[i:]) for i in range(len(parts))]
+
+        now = time.time()
+        cookies = []
+        for domain in domains:
+            key = (store_id, domain)
+            if key in self._evicted:
+                hit = False
+                await self._load_domain(store_id, domain)
+            elif key in self._domains:
+                self._domains.move_to_end(key)
+
+            for cookie in self._domains.get(key, {}).values():
+                if cookie.get('secure') and not secure:
+                    continue
+                if not partitioned and cookie.get('partitionKey'):
+                    continue
+                if (expires := cookie.get('expirationDate')) and expires < now:
+                    continue
+                cookie_path = cookie['path']
+                if path != cookie_path and not (path.startswith(cookie_path) and (cookie_path.endswith('/') or path[len(cookie_path)] == '/')):
+                    continue
+                cookies.append(cookie)
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        # longer paths first, like browsers do
+        cookies.sort(key=lambda c: -len(c['path']))
+        return cookies
+
+class HttpResponse:
+    def __init__(self, pool, key, conn, method, request_headers):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._method = method
+        self._reusable = False
+        self.request_headers = request_headers
+        self.version = None
+        self.status = None
+        self.headers = []
+
+    def get_all(self, name):
+        name = name.lower()
+        return [v for k, v in self.headers if k.lower() == name]
+
+    def get(self, name, default=None):
+        return next(iter(self.get_all(name)), default)
+
+    async def _read_head(self):
+        reader = self._conn[0]
+        while True:
+            head = (await reader.readuntil(b'\r\n\r\n')).decode('iso-8859-1').split('\r\n')
+            self.version, status, *_ = head[0].split(' ', 2)
+            self.status = int(status)
+            self.headers = [tuple(x.strip() for x in line.split(':', 1)) for line in head[1:] if ':' in line]
+            # skip 100 continue etc
+            if not 100 <= self.status < 200 or self.status == 101:
+                break
+
+    @property
+    def keep_alive(self):
+        connection = self.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def read(self, size=2**16):
+        # yields the body in chunks
+        reader = self._conn[0]
+        if self._method == 'HEAD' or self.status in (204, 304) or 100 <= self.status < 200:
+            pass
+        elif 'chunked' in self.get('transfer-encoding', '').lower():
+            while length := int((await reader.readuntil(b'\r\n')).split(b';')[0], 16):
+                while length:
+                    data = await reader.read(min(length, size))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', length)
+                    length -= len(data)
+                    yield data
+                await reader.readexactly(2)
+            # trailers
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+        elif (length := self.get('content-length')) is not None:
+            length = int(length)
+            while length:
+                data = await reader.read(min(length, size))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', length)
+                length -= len(data)
+                yield data
+        else:
+            # read until the server closes the connection
+            while data := await reader.read(size):
+                yield data
+            return
+        self._reusable = self.keep_alive
+
+    def release(self):
+        # gives the connection back to the pool, or closes it if the body was not read to the end
+        if self._conn:
+            self._pool._release(self._key, self._conn, self._reusable)
+            self._conn = None
+
+class HttpPool:
+    # keep-alive HTTP/1.1 connections, reused per host, for fake_fetch
+    # at most max_per_host connections are open to a host at once and at most max_idle are kept around
+    def __init__(self, max_per_host=6, max_idle=32, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # key -> [(reader, writer, last used)]
+        self._idle = collections.defaultdict(list)
+        self._limits = collections.defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        self._ssl = None
+        self.opened = 0
+        self.reused = 0
+
+    def stats(self):
+        return dict(opened=self.opened, reused=self.reused, idle=sum(map(len, self._idle.values())))
+
+    def close(self):
+        for conns in self._idle.values():
+            for _, writer, _ in conns:
+                writer.close()
+        self._idle.clear()
+
+    def _ssl_context(self):
+        if self._ssl is None:
+            import ssl
+            # one context for all connections
+            self._ssl = ssl.create_default_context()
+        return self._ssl
+
+    @staticmethod
+    def _get_proxy(scheme, host):
+        import urllib.request
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            return proxy
+
+    async def _connect(self, scheme, host, port, proxy):
+        import urllib.parse
+        if not proxy:
+            self.opened += 1
+            return await asyncio.open_connection(host, port, ssl=self._ssl_context() if scheme == 'https' else None, server_hostname=host if scheme == 'https' else None, limit=2**20)
+
+        proxy = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port or 80, limit=2**20)
+        self.opened += 1
+        if scheme == 'https':
+            # tunnel through the proxy
+            headers = f'Host: {host}:{port}\r\n'
+            if auth := self._proxy_auth(proxy):
+                headers += f'Proxy-Authorization: {auth}\r\n'
+            writer.write(f'CONNECT {host}:{port} HTTP/1.1\r\n{headers}\r\n'.encode('iso-8859-1'))
+            response = HttpResponse(self, None, (reader, writer), 'CONNECT', [])
+            await response._read_head()
+            if response.status != 200:
+                writer.close()
+                raise ConnectionError(f'proxy CONNECT to {host}:{port} failed with status {response.status}')
+            await writer.start_tls(self._ssl_context(), server_hostname=host)
+        return reader, writer
+
+    @staticmethod
+    def _proxy_auth(proxy):
+        # value of the Proxy-Authorization header for the split proxy url, if it has credentials
+        if proxy.username is None:
+            return None
+        import urllib.parse
+        auth = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+        return 'Basic ' + base64.b64encode(auth.encode('utf8')).decode('ascii')
+
+    def _checkout(self, key):
+        conns = self._idle[key]
+        while conns:
+            reader, writer, used = conns.pop()
+            if time.monotonic() - used < self.idle_timeout and not reader.at_eof() and not writer.is_closing():
+                self.reused += 1
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release(self, key, conn, reusable):
+        if reusable and not conn[1].is_closing() and sum(map(len, self._idle.values())) < self.max_idle:
+            self._idle[key].append((*conn, time.monotonic()))
+        else:
+            conn[1].close()
+        self._limits[key].release()
+
+    async def request(self, method, url, headers=(), body=b''):
+        # sends the request and returns a HttpResponse once the status and headers are in
+        # call release() on it once done with the body
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported url: {url}')
+        port = parts.port or (443 if scheme == 'https' else 80)
+        host = parts.hostname
+        netloc = host if ':' not in host else f'[{host}]'
+        if parts.port:
+            netloc += f':{parts.port}'
+        proxy = self._get_proxy(scheme, host)
+
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if proxy and scheme == 'http':
+            target = urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+        request_headers = {'Host': netloc}
+        request_headers.update((k.title(), v) for k, v in dict(headers).items())
+        if body or method in ('POST', 'PUT', 'PATCH'):
+            request_headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+            request_headers['Content-Length'] = str(len(body))
+        if proxy and scheme == 'http' and (auth := self._proxy_auth(urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy))):
+            request_headers['Proxy-Authorization'] = auth
+        request_headers = list(request_headers.items())
+        data = f'{method} {target} HTTP/1.1\r\n'.encode('iso-8859-1')
+        data += b''.join(f'{k}: {v}\r\n'.encode('iso-8859-1') for k, v in request_headers) + b'\r\n' + (body or b'')
+
+        key = (scheme, host, port, proxy)
+        await self._limits[key].acquire()
+        try:
+            while True:
+                conn = self._checkout(key)
+                reused = conn is not None
+                conn = conn or await self._connect(scheme, host, port, proxy)
+                response = HttpResponse(self, key, conn, method, request_headers)
+                try:
+                    conn[1].write(data)
+                    await conn[1].drain()
+                    await response._read_head()
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn[1].close()
+                    # the server may have closed an idle connection just as we sent on it
+                    if reused and method in ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'):
+                        continue
+                    raise
+                except BaseException:
+                    conn[1].close()
+                    raise
+                return response
+        except BaseException:
+            self._limits[key].release()
+            raise
+
+class ProfileCache:
+    # answers that are slow to get and rarely change, kept in ffcli-cache.json next to ffcli.sock
+    # so that separate runs can share them
+    # the file is ignored once the extension id or the browser user agent (which has its version) changes
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self._values = None
+        self._stamp = None
+        # so that concurrent lookups fetch each value once
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        if self._values is not None:
+            return
+        # both of these are answered by ffcli-server's own cache
+        self._stamp = list(await asyncio.gather(self._client.id(), self._client.userAgent()))
+        self._values = {}
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('stamp') == self._stamp:
+            self._values = data.get('values', {})
+
+    def _save(self):
+        tmp = f'{self.path}.{os.getpid()}'
+        with open(tmp, 'w') as file:
+            json.dump({'stamp': self._stamp, 'values': self._values}, file)
+        os.replace(tmp, self.path)
+
+    async def get(self, key, fetch, refresh=False):
+        # returns the cached value for key, or calls fetch() to get it
+        async with self._lock:
+            await self._load()
+            if refresh or key not in self._values:
+                self._values[key] = await fetch()
+                try:
+                    self._save()
+                except OSError as e:
+                    logging.warning('failed to save %s: %s', self.path, e)
+            return self._values[key]
+
+class Tracer:
+    # records a span per call as chrome trace event json, see Client(trace=...)
+    # the file can be opened in https://ui.perfetto.dev or chrome://tracing
+    def __init__(self, path=None):
+        self.path = path
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': os.path.basename(sys.argv[0]) or 'python'}}]
+        self.start = time.perf_counter()
+        # request id -> [fn, start, request bytes, first frame, frames, reply bytes]
+        self.calls = {}
+        self._span_id = 0
+
+    def now(self):
+        # trace events are in microseconds
+        return (time.perf_counter() - self.start) * 1e6
+
+    def _event(self, ph, name, id, ts, cat='rpc', **args):
+        # async events, since calls overlap
+        event = {'name': name, 'cat': cat, 'ph': ph, 'ts': ts, 'pid': os.getpid(), 'tid': 0, 'id': id}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def on_request(self, id, fn, size):
+        self.calls[id] = [fn, self.now(), size, None, 0, 0]
+
+    def on_reply(self, id, size, complete):
+        if (call := self.calls.get(id)) is None:
+            return
+        now = self.now()
+        if call[3] is None:
+            call[3] = now
+        call[4] += 1
+        call[5] += size
+        if complete:
+            del self.calls[id]
+            self._add_call(id, call, now)
+
+    def _add_call(self, id, call, end, **args):
+        fn, start, request_bytes, first, frames, reply_bytes = call
+        self._event('b', fn, id, start)
+        if first is not None:
+            self._event('b', 'first frame', id, start)
+            self._event('e', 'first frame', id, first)
+        self._event(
+            'e', fn, id, end,
+            request_bytes=request_bytes,
+            reply_bytes=reply_bytes,
+            frames=frames,
+            first_frame_ms=first and (first - start) / 1000,
+            complete_ms=(end - start) / 1000,
+            **args,
+        )
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # a span around anything else, e.g. a whole proxy flow
+        self._span_id += 1
+        id = f'span-{self._span_id}'
+        self._event('b', name, id, self.now(), cat='span')
+        try:
+            yield
+        finally:
+            self._event('e', name, id, self.now(), cat='span', **args)
+
+    def save(self, path=None):
+        # calls that have not completed yet are saved as far as they got
+        now = self.now()
+        count = len(self.events)
+        for id, call in self.calls.items():
+            self._add_call(id, call, now, incomplete=True)
+        events = self.events
+        self.events = events[:count]
+        with open(path or self.path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
 class Client:
     @classmethod
-    def from_profile(cls, profile):
+    def from_profile(cls, profile, **kwargs):
         path = profile
         if '/' not in path and not os.path.exists(path):
+            import configparser
             conf = configparser.ConfigParser(interpolation=None)
             conf.read(os.path.expanduser('~/.mozilla/firefox/profiles.ini'))
             for v in conf.values():
@@ -211,19 +984,32 @@ class Client:
 
         if not os.path.exists(os.path.join(path, 'ffcli.sock')):
             raise ValueError('invalid profile or not running: %s' % path)
-        return cls(path)
+        return cls(path, **kwargs)
 
-    def __init__(self, profile_dir):
+    def __init__(self, profile_dir, binary=True, cookie_cache=False, http_pool=None, trace=None):
         self.__sock_path = profile_dir + '/ffcli.sock'
+        # connections for fake_fetch, http_pool has keyword arguments for HttpPool
+        self.http = HttpPool(**(http_pool or {}))
+        self.profile_cache = ProfileCache(self, profile_dir + '/ffcli-cache.json')
         self.__reader = None
         self.__writer = None
         self.__id = 0
         self.__queues = {}
         self.__running = False
+        self.__binary = binary
+        # worth it for long running clients making many requests, e.g. the mitm proxy
+        self.cookie_cache = cookie_cache and CookieCache(self, **(cookie_cache if isinstance(cookie_cache, dict) else {}))
+        # a file to write a trace of every call to when the client stops, or a Tracer
+        self.tracer = trace if isinstance(trace, Tracer) or not trace else Tracer(trace)
 
     async def _connect(self):
         if not self.__reader or not self.__writer:
-            self.__reader, self.__writer = await asyncio.open_unix_connection(self.__sock_path, limit=float('inf'))
+            # the limit only bounds how much is read ahead of the replies being used, see read_line
+            self.__reader, self.__writer = await asyncio.open_unix_connection(self.__sock_path, limit=2**20)
+            if self.__binary:
+                # ask for fetch bodies as raw bytes
+                # older servers will pass this to the extension, which errors and the reply is dropped
+                self.__writer.write(json.dumps({'id': 0, 'fn': '__binary__', 'args': []}).encode('utf8') + b'\n')
         return self.__reader, self.__writer
 
     async def __aenter__(self):
@@ -232,9 +1018,18 @@ class Client:
         return self
 
     async def __aexit__(self, *args):
+        if self.cookie_cache:
+            self.cookie_cache.close()
+        self.http.close()
+        if self.tracer and self.tracer.path:
+            self.tracer.save()
         if self.__writer:
             self.__writer.close()
-            await self.__writer.wait_closed()
+            try:
+                await self.__writer.wait_closed()
+            except (ConnectionResetError, BrokenPipeError):
+                # ffcli-server went away first
+                pass
 
     async def start(self):
         if not self.__running:
@@ -249,9 +1044,18 @@ class Client:
 
     async def _read_from_socket(self):
         reader, _ = await self._connect()
-        while line := await reader.readline():
+        tracer = self.tracer
+        while line := await read_line(reader):
             if (data := parse_json_object(line)) is not None:
-                if queue := self.__queues.get(data.get('id')):
+                size = len(line)
+                if 'binary' in data:
+                    # raw body follows the header line
+                    size += data['binary']
+                    data['data']['data'] = await reader.readexactly(data.pop('binary'))
+                if tracer:
+                    tracer.on_reply(data.get('id'), size, data.get('complete'))
+                if (queue := self.__queues.get(data.get('id'))) is not None:
+                    # waits here if the queue is bounded and full
                     await queue.put(data)
                     if data.get('complete'):
                         await queue.put(None)
@@ -259,14 +1063,81 @@ class Client:
         for queue in self.__queues.values():
             queue.shutdown()
 
-    async def _execute(self, fn, *args):
+    def _register(self, queue):
+        # gives a request its id and makes the queue for its replies
+        # this is done before sending in case the reply arrives before the drain finishes
         self.__id += 1
-        _, writer = await self._connect()
-        writer.write(json.dumps({'id': self.__id, 'fn': fn, 'args': args}).encode('utf8'))
-        writer.write(b'\n')
+        queue.id = self.__id
+        self.__queues[queue.id] = queue
+
+    async def _execute(self, fn, *args, queue, timeout=None, options=None):
+        id = queue.id
+        try:
+            _, writer = await self._connect()
+        except asyncio.CancelledError:
+            self.__queues.pop(id, None)
+            raise
+        if self.__queues.get(id) is not queue:
+            # cancelled before it was sent
+            return queue
+        request = {'id': id, 'fn': fn, 'args': args, **(options or {})}
+        if timeout is not None:
+            request['timeout'] = timeout
+        data = json.dumps(request).encode('utf8') + b'\n'
+        if self.tracer:
+            self.tracer.on_request(id, fn, len(data))
+        writer.write(data)
+        queue.flow = partial(self._flow_control, id)
         await writer.drain()
-        self.__queues[self.__id] = asyncio.Queue()
-        return self.__queues[self.__id]
+        return queue
+
+    def cancel(self, id):
+        # stops a request in ffcli-server and the browser, any more replies to it are dropped
+        # ffcli-server ignores this for a request that was never sent
+        if self.__queues.pop(id, None) is None:
+            return
+        if self.__writer and not self.__writer.is_closing():
+            self.__writer.write(json.dumps({'id': id, 'type': 'cancel'}).encode('utf8') + b'\n')
+
+    def _flow_control(self, id, pause):
+        # asks ffcli-server to pause or resume the stream of a request, for ReplyQueue(overflow='pause')
+        if id in self.__queues and self.__writer and not self.__writer.is_closing():
+            self.__writer.write(json.dumps({'id': id, 'type': 'pause' if pause else 'resume'}).encode('utf8') + b'\n')
+
+    def request(self, fn, args, **queue_args):
+        return Response(self, fn, args, **queue_args)
+
+    def batch(self, size=None, window=None):
+        # collects calls and sends them in one message (or one per `size` calls) when the context exits
+        return Batch(self, size, window)
+
+    async def set_cookies(self, cookies, batch_size=500, window=4, progress=None):
+        # sets many cookies with a few batches in flight at once
+        # calls progress(done, total) as batches finish and returns [(cookie, error)] for those that failed
+
+        # the last cookie for each slot wins, just like setting them one by one
+        # this also means batches in flight at the same time never race on the same cookie
+        unique = {}
+        for cookie in cookies:
+            key = tuple(json.dumps(cookie.get(k), sort_keys=True) for k in ('storeId', 'url', 'domain', 'name', 'path', 'partitionKey', 'firstPartyDomain'))
+            unique.pop(key, None)
+            unique[key] = cookie
+        cookies = list(unique.values())
+
+        batch = self.batch(batch_size, window)
+        responses = [batch.browser.cookies.set(c) for c in cookies]
+        sender = asyncio.ensure_future(batch.send())
+
+        errors = []
+        for i, (cookie, response) in enumerate(zip(cookies, responses), 1):
+            try:
+                await response
+            except Error as e:
+                errors.append((cookie, e.args[0]))
+            if progress and (i % batch_size == 0 or i == len(cookies)):
+                progress(i, len(cookies))
+        await sender
+        return errors
 
     def make_request_builder(self, key):
         return RequestBuilder(self, key)
@@ -278,120 +1149,152 @@ class Client:
         kwargs = {**(args or {}), **kwargs}
         return Subscription(self, event, num_events, **kwargs)
 
-    def fetch(self, url, method='GET', headers=(), body=b'', store_id=None, **kwargs):
+    def fetch(self, url, method='GET', headers=(), body=b'', store_id=None, maxsize=0, overflow='pause', **kwargs):
+        # maxsize bounds how many replies are buffered for a slow reader, see ReplyQueue
+        # by default the body is then paused in the browser until the reader catches up
         return FetchWrapper(Response(self, 'fetch', (url, {
             'method': method,
             'headers': headers,
             'body': base64.b64encode(body).decode('utf8') or None,
             'cookieStoreId': store_id,
             **kwargs
-        })).iter())
-
-    async def _fake_fetch(self, url, method='GET', headers=(), body=b'', redirect='follow', store_id=None, real_ua=False):
-        loop = asyncio.get_event_loop()
+        }), maxsize=maxsize, overflow=overflow).iter())
+
+    async def get_cookies(self, url, store_id=None, partitioned=False):
+        if self.cookie_cache:
+            return await self.cookie_cache.get(url, store_id, partitioned)
+        query = {'url': url, 'storeId': store_id}
+        if partitioned:
+            query['partitionKey'] = {}
+        return await self.browser.cookies.getAll(query)
+
+    @staticmethod
+    def _parse_set_cookie(header, url, store_id):
+        import http.cookies
+        import email.utils
+        cookie = http.cookies.BaseCookie()
+        cookie.load(header)
+        attrs = list(cookie.values())[0]
+
+        if expires := attrs.get('expires'):
+            expires = email.utils.parsedate_tz(attrs.get('expires'))
+            expires = expires and email.utils.mktime_tz(expires)
+        elif (max_age := attrs.get('max-age')) and max_age.isdigit():
+            expires = time.time() + int(max_age)
+
+        return {
+            'domain': attrs.get('domain'),
+            'expirationDate': expires,
+            # 'firstPartyDomain': ...,
+            'httpOnly': 'httponly' in attrs,
+            'name': attrs.key,
+            'partitionKey': None,
+            'path': attrs.get('path'),
+            'sameSite': {
+                'none': 'no_restriction',
+                'lax': 'lax',
+                'strict': 'strict',
+            }.get(attrs.get('samesite', '').lower(), 'no_restriction'),
+            'secure': 'secure' in attrs,
+            'storeId': store_id,
+            'url': url,
+            'value': attrs.value,
+        }
+
+    async def _fake_fetch(self, url, method='GET', headers=(), body=b'', redirect='follow', store_id=None, real_ua=False, max_redirects=20, user_agent=None):
+        import urllib.parse
+        user_agent = user_agent or await self.get_user_agent(real=real_ua)
+        headers = dict(headers)
+
+        for _ in range(max_redirects + 1):
+            cookie_list = await self.get_cookies(url, store_id)
+            request_headers = {**headers, 'User-Agent': user_agent}
+            if cookie_list:
+                request_headers['Cookie'] = '; '.join(c['name']+'='+c['value'] for c in cookie_list)
+
+            response = await self.http.request(method, url, request_headers, body)
+            try:
+                yield {
+                    'type': 'sendHeaders',
+                    'data': dict(
+                        url=url,
+                        method=method,
+                        requestHeaders=[{'name': k, 'value': v} for k, v in response.request_headers],
+                    ),
+                }
+                yield {
+                    'type': 'headersReceived',
+                    'data': dict(
+                        statusCode=response.status,
+                        responseHeaders=[{'name': k, 'value': v} for k, v in response.headers],
+                    ),
+                }
+                async for data in response.read():
+                    yield {'type': 'responseBody', 'data': data}
+            finally:
+                response.release()
 
-        cookie_list = await self.browser.cookies.getAll({'url': url, 'storeId': store_id})
-        user_agent = (await self.get_user_agent(real=real_ua))[0]
-
-        request = urllib.request.Request(url, method=method, headers=headers, data=body)
-        request.headers['user-agent'] = user_agent
-        if cookie_list:
-            request.headers["cookie"] = '; '.join(c['name']+'='+c['value'] for c in cookie_list)
-
-
-        queue = asyncio.Queue()
-
-        def thread():
-            send = partial(loop.call_soon_threadsafe, queue.put_nowait)
-            set_cookies = lambda *args: self.__writer.is_closing() or loop.call_soon_threadsafe(self.browser.cookies.set, *args)
-
-            class Finish(Exception): pass
-
-            class RequestHandler(urllib.request.BaseHandler):
-                handler_order = 99999 # last
-                def http_request(self, req):
-                    headers = {k.title(): v for k, v in req.unredirected_hdrs.items()}
-                    headers.update({k.title(): v for k, v in req.headers.items() if k.title() not in headers})
-
-                    send({
-                        'type': 'sendHeaders',
-                        'data': dict(
-                            url=req.type + '://' + req.host + req.selector,
-                            method=method,
-                            requestHeaders=[{'name': k, 'value': v} for k, v in headers.items()],
-                        ),
-                    })
-                    return req
-                https_request = http_request
-
-            class ResponseHandler(urllib.request.HTTPRedirectHandler, urllib.request.HTTPDefaultErrorHandler):
-                handler_order = 0 # first
-                def http_response(self, req, response):
-                    send({
-                        'type': 'headersReceived',
-                        'data': dict(
-                            statusCode=response.status,
-                            responseHeaders=[{'name': k, 'value': v} for k, v in response.headers.items()],
-                        ),
-                    })
-                    # read the body
-                    while data := response.read1():
-                        send({'type': 'responseBody', 'data': data})
-
-                    for c in response.headers.get_all('set-cookie') or ():
-                        cookie = http.cookies.BaseCookie()
-                        cookie.load(c)
-                        attrs = list(cookie.values())[0]
-
-                        if expires := attrs.get('expires'):
-                            expires = email.utils.parsedate_tz(attrs.get('expires'))
-                            expires = expires and email.utils.mktime_tz(expires)
-                        elif (max_age := attrs.get('max-age')) and max_age.isdigit():
-                            expires = time.time() + int(max_age)
-
-                        set_cookies({
-                            'domain': attrs.get('domain'),
-                            'expirationDate': expires,
-                            # 'firstPartyDomain': ...,
-                            'httpOnly': 'httponly' in attrs,
-                            'name': attrs.key,
-                            'partitionKey': None,
-                            'path': attrs.get('path'),
-                            'sameSite': {
-                                'none': 'no_restriction',
-                                'lax': 'lax',
-                                'strict': 'strict',
-                            }.get(attrs.get('samesite', '').lower(), 'no_restriction'),
-                            'secure': 'secure' in attrs,
-                            'storeId': store_id,
-                            'url': url,
-                            'value': attrs.value,
-                        })
-                    return response
-                https_response = http_response
-
-                def http_error_default(self, req, *args):
-                    pass
+            if cookies := [self._parse_set_cookie(c, url, store_id) for c in response.get_all('set-cookie')]:
+                for cookie, error in await self.set_cookies(cookies):
+                    logging.warning('failed to set cookie %s: %s', cookie['name'], error)
 
-                if redirect != 'follow':
-                    def redirect_request(self, *args):
-                        raise Finish
+            location = response.get('location')
+            if redirect != 'follow' or response.status not in (301, 302, 303, 307, 308) or not location:
+                return
 
-            try:
-                urllib.request.build_opener(RequestHandler, ResponseHandler).open(request)
-            except Finish:
-                pass
+            # like browsers do
+            url = urllib.parse.urljoin(url, location)
+            if (response.status == 303 and method != 'HEAD') or (response.status in (301, 302) and method == 'POST'):
+                method = 'GET'
+                body = b''
+                headers = {k: v for k, v in headers.items() if k.lower() not in ('content-type', 'content-length')}
 
-        fut = asyncio.ensure_future(loop.run_in_executor(None, thread))
-        fut.add_done_callback(lambda f: queue.put_nowait(None))
-        while data := await queue.get():
-            yield data
-        await fut
+        raise Exception(f'too many redirects: {url}')
 
     def fake_fetch(self, *args, **kwargs):
         return FetchWrapper(self._fake_fetch(*args, **kwargs))
 
-    async def get_user_agent(self, real=False, tab=None, url='https://google.com/404'):
+    async def scrape(self, selector, keys=None, query=None, jobs=8, timeout=None):
+        # dom.get(selector, keys) in every tab matching the browser.tabs.query query, jobs tabs at a time
+        # yields {'tabId': ..., 'url': ..., 'data': ...} for each tab as it finishes, or 'error' instead of 'data'
+        # timeout is per tab, so one slow page does not hold up the rest
+        in_flight = asyncio.Semaphore(jobs)
+
+        async def scrape_tab(tab):
+            row = {'tabId': tab['id'], 'url': tab.get('url')}
+            async with in_flight:
+                try:
+                    row['data'] = await self.request('dom.get', (selector, keys, {'tabId': tab['id']}), timeout=timeout)
+                except TimeoutError:
+                    row['error'] = {'error': f'timed out after {timeout}s'}
+                except Error as e:
+                    row['error'] = e.args[0]
+            return row
+
+        tasks = [asyncio.ensure_future(scrape_tab(tab)) for tab in await self.browser.tabs.query(query or {})]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_store_id(self, container, refresh=False):
+        # the cookie store id of the container with this name
+        async def fetch():
+            identities = await self.browser.contextualIdentities.query({'name': container})
+            if not identities:
+                raise ValueError(f'no such container: {container}')
+            return identities[0]['cookieStoreId']
+        return await self.profile_cache.get('container:' + container, fetch, refresh)
+
+    async def get_user_agent(self, real=False, tab=None, url='https://google.com/404', refresh=False):
+        if real and tab is None:
+            # getting this may need a new tab, so remember it
+            return await self.profile_cache.get('real_user_agent', partial(self._get_user_agent, real, tab, url), refresh)
+        return await self._get_user_agent(real, tab, url)
+
+    async def _get_user_agent(self, real=False, tab=None, url='https://google.com/404'):
         close_tab = False
 
         if real:
@@ -414,28 +1317,259 @@ class Client:
                     pass
 
         try:
-            return await self.userAgent(tab)
+            user_agent = await self.userAgent(tab)
+            # from a tab there is one per frame
+            return user_agent[0] if isinstance(user_agent, list) else user_agent
         finally:
             if close_tab:
                 await self.browser.tabs.remove(close_tab)
 
+class PngStitcher:
+    # joins png tiles of the same width top to bottom into one png, written out as each tile is added
+    # the rows of a tile are copied over still filtered, only the first has to be decoded
+    # the height is filled in by close(), so the file must be seekable
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    # colour type -> channels, palettes are not supported
+    CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+    def __init__(self, file):
+        self.file = file
+        self.header = None
+        self.height = 0
+        self.compressor = zlib.compressobj()
+
+    def _chunks(self, data):
+        if not data.startswith(self.SIGNATURE):
+            raise ValueError('not a png')
+        pos = len(self.SIGNATURE)
+        while pos < len(data):
+            length, kind = struct.unpack_from('>I4s', data, pos)
+            yield kind, data[pos + 8 : pos + 8 + length]
+            pos += 12 + length
+
+    def _write_chunk(self, kind, data):
+        if data or kind != b'IDAT':
+            self.file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    @staticmethod
+    def _unfilter_first_row(row, bpp):
+        # the previous row of the first row of a tile is all zeros
+        # but in the stitched image it is the last row of the tile above,
+        # so rewrite it with a filter that does not look at the previous row
+        kind, row = row[0], bytearray(row[1:])
+        if kind == 2:
+            # up, from zeros
+            kind = 0
+        elif kind == 3:
+            # average, of zeros and the pixel to the left
+            for i in range(bpp, len(row)):
+                row[i] = (row[i] + row[i - bpp] // 2) & 0xff
+            kind = 0
+        elif kind == 4:
+            # paeth, which picks the pixel to the left when the row above is zeros, i.e. sub
+            kind = 1
+        return bytes([kind]) + row
+
+    def add(self, data):
+        decompressor = zlib.decompressobj()
+        header = None
+        rows = bytearray()
+        for kind, body in self._chunks(data):
+            if kind == b'IHDR':
+                header = body
+            elif kind == b'IDAT':
+                rows += decompressor.decompress(body)
+
+        width, height, depth, colour, _, _, interlace = struct.unpack('>IIBBBBB', header)
+        if colour not in self.CHANNELS or interlace:
+            raise ValueError(f'unsupported png: colour type {colour}, interlace {interlace}')
+        if self.header is None:
+            self.header = header
+            self.file.write(self.SIGNATURE)
+            self._write_chunk(b'IHDR', header)
+        elif header[:4] + header[8:] != self.header[:4] + self.header[8:]:
+            raise ValueError('tiles have different widths or formats')
+
+        bits = self.CHANNELS[colour] * depth
+        stride = 1 + (width * bits + 7) // 8
+        rows[:stride] = self._unfilter_first_row(rows[:stride], max(1, bits // 8))
+        self.height += height
+        self._write_chunk(b'IDAT', self.compressor.compress(rows))
+
+    def close(self):
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self.file.seek(len(self.SIGNATURE))
+        self._write_chunk(b'IHDR', self.header[:4] + struct.pack('>I', self.height) + self.header[8:])
+        self.file.seek(0, os.SEEK_END)
+
 def with_client(fn):
     async def wrapped(args):
-        async with Client.from_profile(args.profile) as client:
+        async with Client.from_profile(args.profile, trace=args.trace) as client:
             return (await fn(client, args))
     return wrapped
 
 class actions:
     @with_client
     async def do(client, args):
-        async for data in client.make_request_builder(args.fn)(*args.args).iter():
-            print(json.dumps(data), flush=True)
+        # other subcommands reuse this without all of the options of do
+        if getattr(args, 'batch', False):
+            return await actions._do_batch(client, args)
+        timeout = getattr(args, 'timeout', None)
+        options = {}
+        if fields := getattr(args, 'fields', None):
+            options['fields'] = fields
+        if where := getattr(args, 'where', None):
+            options['where'] = where
+        try:
+            async for data in client.request(args.fn, args.args, timeout=timeout, options=options).iter():
+                print(json.dumps(data), flush=True)
+        except TimeoutError:
+            print(f'{args.fn} timed out after {timeout}s', file=sys.stderr)
+            return 1
+
+    async def _do_batch(client, args):
+        # each line of stdin is a request like {"id": ..., "fn": ..., "args": [...]}
+        ids = []
+        responses = []
+        async with client.batch(args.batch_size) as batch:
+            for lineno, line in enumerate(sys.stdin, 1):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    id, fn, fn_args = request.get('id'), request['fn'], request.get('args') or ()
+                except (ValueError, KeyError, AttributeError) as e:
+                    # answered with an error like shell does, without holding up the rest
+                    response = BatchResponse(None, None)
+                    response.resolve({'type': 'error', 'data': {'error': f'invalid request on line {lineno}: {e!r}'}})
+                    id = lineno
+                else:
+                    response = batch.request(fn, fn_args)
+                ids.append(id)
+                responses.append(response)
+
+        code = 0
+        for id, response in zip(ids, responses):
+            item = {'id': id, 'type': 'data'}
+            try:
+                item['data'] = await response
+            except Error as e:
+                item.update(type='error', data=e.args[0])
+                code = 1
+            print(json.dumps(item), flush=True)
+        return code
+
+    @with_client
+    async def shell(client, args):
+        # runs requests from stdin over one connection, many at a time
+        # lines are either NDJSON requests or `FN ARGS...` like `ffcli.py do`
+        loop = asyncio.get_event_loop()
+        in_flight = asyncio.Semaphore(args.max_in_flight)
+        tasks = set()
+
+        def output(item):
+            # bodies arrive as raw bytes in binary mode
+            print(json.dumps(item, default=lambda x: base64.b64encode(x).decode('utf8')), flush=True)
+
+        async def run(id, fn, fn_args):
+            try:
+                # keep the response, dropping it cancels the call
+                response = client.request(fn, fn_args)
+                queue = await response.get_queue()
+                while item := await queue.get():
+                    output({**item, 'id': id})
+            except getattr(asyncio, 'QueueShutDown', ()):
+                # the connection to ffcli-server was lost, QueueShutDown is only in python 3.13+
+                output({'id': id, 'type': 'error', 'data': {'error': 'connection to ffcli-server lost'}, 'complete': True})
+            finally:
+                in_flight.release()
+
+        lineno = 0
+        while line := await loop.run_in_executor(None, sys.stdin.readline):
+            lineno += 1
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                if line.startswith('{'):
+                    request = json.loads(line)
+                    id, fn, fn_args = request.get('id'), request['fn'], request.get('args') or ()
+                else:
+                    import shlex
+                    fn, *fn_args = shlex.split(line)
+                    id, fn_args = lineno, [parse_maybe_json(a) for a in fn_args]
+            except (ValueError, KeyError, AttributeError) as e:
+                output({'id': lineno, 'type': 'error', 'data': {'error': f'invalid request on line {lineno}: {e!r}'}, 'complete': True})
+                continue
+
+            await in_flight.acquire()
+            task = asyncio.ensure_future(run(id, fn, fn_args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
 
     def status(args):
         args.fn = 'status'
         args.args = ()
         return actions.do(args)
 
+    @with_client
+    async def stats(client, args):
+        # what ffcli-server has been doing, see __stats__
+        previous = None
+        while True:
+            report = await client.request('__stats__', ())
+            if args.json:
+                print(json.dumps(report), flush=True)
+            else:
+                if args.watch:
+                    # clear the screen
+                    print('\x1b[H\x1b[J', end='')
+                actions._print_stats(report, previous)
+            if not args.watch:
+                break
+            previous = report
+            await asyncio.sleep(args.watch)
+
+    def _print_stats(report, previous=None):
+        def size(n):
+            for unit in ('B', 'KB', 'MB', 'GB'):
+                if abs(n) < 1024 or unit == 'GB':
+                    return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+                n /= 1024
+
+        print(f'uptime {report["uptime"]:.0f}s, {len(report["clients"])} client(s)')
+        print()
+        elapsed = previous and report['uptime'] - previous['uptime']
+        print(f'{"traffic":<16} {"messages":>10} {"bytes":>10}' + (f' {"msg/s":>10} {"bytes/s":>10}' if elapsed else ''))
+        for direction, traffic in report['traffic'].items():
+            line = f'{direction:<16} {traffic["messages"]:>10} {size(traffic["bytes"]):>10}'
+            if elapsed:
+                before = previous['traffic'][direction]
+                line += f' {(traffic["messages"] - before["messages"]) / elapsed:>10.0f} {size((traffic["bytes"] - before["bytes"]) / elapsed) + "/s":>10}'
+            print(line)
+        print()
+        queue = report['extension_queue']
+        print(f'queued for the extension: {queue["control"]} control, {queue["requests"]} requests ({size(queue["bytes"])})')
+        print()
+        print(f'{"client":<8} {"in flight":>10} {"requests":>10} {"replies":>10} {"paused":>7} {"subs":>5}')
+        for c in report['clients']:
+            requests = f'{c["queued_requests"]} {size(c["queued_request_bytes"])}'
+            replies = f'{c["queued_replies"]} {size(c["queued_reply_bytes"])}'
+            print(f'{c["id"]:<8} {c["in_flight"]:>10} {requests:>10} {replies:>10} {c["paused"]:>7} {c["subscriptions"]:>5}')
+        print()
+        print(f'{"fn":<40} {"count":>8} {"mean":>9} {"p50":>7} {"p99":>7}')
+        for fn, latency in report['latency'].items():
+            print(f'{fn:<40} {latency["count"]:>8} {latency["mean_ms"]:>7.1f}ms {latency["p50_ms"]:>5}ms {latency["p99_ms"]:>5}ms')
+        cache = report['cache']
+        print()
+        print(f'cache: {cache["size"]} entries, {cache["hit_rate"]:.0%} hit rate')
+        sys.stdout.flush()
+
     @with_client
     async def _crud(client, args):
         verb = dict(create='create', list='query', get='get', update='update', delete='remove')[args.CMD]
@@ -459,8 +1593,7 @@ class actions:
 
         props = {}
         if hasattr(args, 'props'):
-            props = dict(x.partition('=')[::2] for x in args.props)
-            props = {k: parse_maybe_json(v) for k, v in props.items()}
+            props = parse_props(args.props)
             a.append(props)
 
         if not a:
@@ -482,35 +1615,119 @@ class actions:
 
     @with_client
     async def user_agent(client, args, url='https://google.com/404'):
-        print(await client.get_user_agent(real=args.real, tab=args.tab))
+        print(await client.get_user_agent(real=args.real, tab=args.tab, refresh=args.refresh))
+
+    def _expand_url(url):
+        # curl style globs: {a,b,c} and [1-10], [01-10:2], [a-z]
+        # yields each url with the values of its globs, for #1, #2, ... in the output name
+        match = re.search(r'\{([^{}]*)\}|\[(\d+)-(\d+)(?::(\d+))?\]|\[([a-zA-Z])-([a-zA-Z])(?::(\d+))?\]', url)
+        if not match:
+            yield url, []
+            return
+
+        if match[1] is not None:
+            values = match[1].split(',')
+        elif match[2] is not None:
+            width = len(match[2]) if match[2].startswith('0') else 0
+            values = [str(i).zfill(width) for i in range(int(match[2]), int(match[3]) + 1, int(match[4] or 1))]
+        else:
+            values = [chr(i) for i in range(ord(match[5]), ord(match[6]) + 1, int(match[7] or 1))]
+
+        for value in values:
+            for rest, rest_values in actions._expand_url(url[match.end():]):
+                yield url[:match.start()] + value + rest, [value, *rest_values]
+
+    def _read_url_file(path):
+        # one url per line, or curl config style: url = "..."
+        with (sys.stdin if path == '-' else open(path)) as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                # but not a bare url that happens to start with url, e.g. urls.example.com/x
+                if match := re.match(r'(?:--)?url(?:\s*[=:]\s*|\s+)(.*)', line):
+                    line = match[1].strip('"\'')
+                yield line
 
     @with_client
     async def curl(client, args):
+        urls = list(args.urls)
+        for path in args.url_file:
+            urls.extend(actions._read_url_file(path))
+        if not urls:
+            print('no urls given', file=sys.stderr)
+            return 2
+
+        jobs = []
+        for url in urls:
+            for expanded, values in ([(url, [])] if args.globoff else actions._expand_url(url)):
+                # urls without globs use their position as #1
+                values = values or [str(len(jobs) + 1)]
+                output = args.output and re.sub(r'#(\d)', lambda m: values[int(m[1]) - 1] if int(m[1]) <= len(values) else m[0], args.output)
+                jobs.append((expanded, output))
+
+        if args.output and len(jobs) > 1 and len({output for _, output in jobs}) < len(jobs):
+            print('use #1 in --output to write each url to its own file', file=sys.stderr)
+            return 2
+
         headers = dict(h.partition(': ')[::2] for h in args.header)
         store_id = None
         if args.container:
-            store_id = (await client.browser.contextualIdentities.query({'name': args.container}))[0]['cookieStoreId']
+            store_id = await client.get_store_id(args.container, refresh=args.refresh)
         elif args.tab:
             store_id = (await client.browser.tabs.get(args.tab)).get('cookieStoreId')
 
         kwargs = dict(
-            url=args.url,
             method=args.method or ('GET' if args.data is None else 'POST'),
             headers=headers,
             body=(args.data or '').encode('utf8'),
             store_id=store_id,
-            real_ua=args.real_ua,
             redirect='follow' if args.location else 'manual',
         )
+        if not args.real_proxy:
+            # looked up once for all the urls
+            kwargs['user_agent'] = await client.get_user_agent(real=args.real_ua, refresh=args.refresh)
+            if len(jobs) > 1 and not client.cookie_cache:
+                # answers cookie lookups locally after loading the cookies once
+                client.cookie_cache = CookieCache(client)
+
+        # with many urls in parallel, bodies for stdout are buffered so that they do not interleave
+        buffer = args.parallel and len(jobs) > 1
+        limit = asyncio.Semaphore(args.parallel_max if args.parallel else 1)
+        async def run(url, output):
+            async with limit:
+                start = time.monotonic()
+                try:
+                    status, size = await actions._curl_one(client, args, url, output, buffer, kwargs)
+                except Exception as e:
+                    if len(jobs) == 1:
+                        raise
+                    return url, output, None, 0, time.monotonic() - start, e
+                return url, output, status, size, time.monotonic() - start, None
+
+        results = await asyncio.gather(*(run(url, output) for url, output in jobs))
+
+        if len(jobs) > 1:
+            for url, output, status, size, elapsed, error in results:
+                print(f'{status or "-":>3} {size:>10} {elapsed:7.3f}s {url}' + (f' -> {output}' if output else '') + (f' ({error!r})' if error else ''), file=sys.stderr)
+
+        if any(error for *_, error in results):
+            return 1
+        if (args.fail or args.fail_with_body) and any(status >= 400 for _, _, status, *_ in results):
+            return 22
+
+    async def _curl_one(client, args, url, output, buffer, kwargs):
+        # returns the status and number of body bytes
         if args.real_proxy:
-            stream = client.fetch(tabId=args.tab, cache='no-store', **kwargs)
+            stream = client.fetch(url, tabId=args.tab, cache='no-store', **kwargs)
         else:
-            stream = client.fake_fetch(**kwargs)
+            stream = client.fake_fetch(url, **kwargs)
 
         # okk.....
         is_web_request = False
         outfile = None
         status = 0
+        size = 0
         async for type, data in stream.iter():
             if type == 'sendHeaders':
                 is_web_request = True
@@ -539,17 +1756,31 @@ class actions:
             elif type == 'responseBody':
                 if args.fail_with_body or not (args.fail and status >= 400):
                     if outfile is None:
-                        outfile = open(args.output, 'wb') if args.output else sys.stdout.buffer
+                        if output:
+                            if args.create_dirs and os.path.dirname(output):
+                                os.makedirs(os.path.dirname(output), exist_ok=True)
+                            outfile = open(output, 'wb')
+                        else:
+                            outfile = [] if buffer else sys.stdout.buffer
                     if isinstance(data, str):
                         data = base64.b64decode(data)
-                    outfile.write(data)
-
-        if outfile:
+                    size += len(data)
+                    if isinstance(outfile, list):
+                        outfile.append(data)
+                    else:
+                        outfile.write(data)
+
+        if isinstance(outfile, list):
+            sys.stdout.buffer.write(b''.join(outfile))
+            sys.stdout.buffer.flush()
+        elif outfile is sys.stdout.buffer:
+            outfile.flush()
+        elif outfile:
             outfile.close()
 
-        if (args.fail or args.fail_with_body) and status >= 400:
+        if (args.fail or args.fail_with_body) and status >= 400 and not buffer:
             print('The requested URL returned error:', status, file=sys.stderr)
-            return 22
+        return status, size
 
     def _http_proxy_args(args, *mitm_args):
         mitm = [
@@ -565,8 +1796,14 @@ class actions:
             mitm += ['--set', 'firefox_real_proxy=true']
         if args.real_ua:
             mitm += ['--set', 'firefox_real_ua=true']
+        if args.refresh:
+            mitm += ['--set', 'firefox_refresh=true']
         if args.container:
             mitm += ['--set', 'firefox_container='+args.container]
+        if args.stream_buffer is not None:
+            mitm += ['--set', f'firefox_stream_buffer={args.stream_buffer}']
+        if args.trace:
+            mitm += ['--set', 'firefox_trace='+os.path.abspath(args.trace)]
         for host in args.ignore_hosts or ():
             mitm += ['--ignore-hosts', host]
         for host in args.allow_hosts or ():
@@ -579,6 +1816,7 @@ class actions:
         raise Exception('unreachable')
 
     async def with_http_proxy(args):
+        import subprocess
         args.port = args.port or get_free_port()
         mitm = actions._http_proxy_args(args, '--quiet')
         with subprocess.Popen(mitm) as proc:
@@ -630,139 +1868,255 @@ class actions:
                 print(repr(args.selector), 'is not visible', file=sys.stderr)
                 return 1
 
+            # pages taller than the window are captured a window at a time and stitched into the file
+            if args.output and args.format == 'png':
+                tile_height = args.tile_height or (await client.dom.get(':root', 'clientHeight'))[0]
+                if tile_height and kwargs['rect']['height'] > tile_height:
+                    return await actions._screenshot_tiles(client, args.tab, kwargs, tile_height, args.output)
+
         data = await client.browser.tabs.captureTab(args.tab, kwargs)
         data = base64.b64decode(data.partition(',')[2])
+        if args.output:
+            with open(args.output, 'wb') as file:
+                file.write(data)
+            return
         if os.isatty(sys.stdout.fileno()):
+            import subprocess
             proc = subprocess.run(['imv', '-'], input=data)
             return proc.returncode
         sys.stdout.buffer.write(data)
 
+    async def _screenshot_tiles(client, tab, kwargs, tile_height, output):
+        rect = kwargs['rect']
+        tiles = [
+            dict(rect, y=rect['y'] + i * tile_height, height=min(tile_height, rect['height'] - i * tile_height))
+            for i in range(math.ceil(rect['height'] / tile_height))
+        ]
+
+        def capture(tile):
+            return client.browser.tabs.captureTab(tab, {**kwargs, 'rect': tile})
+
+        with open(output, 'wb') as file:
+            stitcher = PngStitcher(file)
+            # capture the next tile while this one is being stitched, but no more than that
+            response = capture(tiles[0])
+            for i in range(len(tiles)):
+                data = await response
+                if i + 1 < len(tiles):
+                    response = capture(tiles[i + 1])
+                stitcher.add(base64.b64decode(data.partition(',')[2]))
+                del data
+            stitcher.close()
+
+    @with_client
+    async def scrape(client, args):
+        keys = args.keys[0] if len(args.keys) == 1 else args.keys
+        code = 0
+        async for row in client.scrape(args.selector, keys, parse_props(args.query), jobs=args.jobs, timeout=args.timeout):
+            print(json.dumps(row), flush=True)
+            if 'error' in row:
+                code = 1
+        return code
+
+    @with_client
+    async def wait(client, args):
+        opts = {'visible': args.visible, 'count': args.count, 'tabId': args.tab or 0}
+        if args.timeout is not None:
+            opts['timeout'] = args.timeout * 1000
+        if not await client.dom.wait(args.selector, opts):
+            print(f'{args.selector!r} did not appear within {args.timeout}s', file=sys.stderr)
+            return 1
+
     @with_client
     async def import_cookies(client, args):
+        import http.cookiejar
+        store_id = None
         if args.container:
-            store_id = (await client.browser.contextualIdentities.query({'name': args.container}))[0]['cookieStoreId']
+            store_id = await client.get_store_id(args.container)
 
-        cookies = http.cookiejar.MozillaCookieJar(args.file)
+        jar = http.cookiejar.MozillaCookieJar(args.file)
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            cookies.load(ignore_discard=True)
-
-        for values in cookies._cookies.values():
-            for values in values.values():
-                for cookie in values.values():
-                    await client.browser.cookies.set({
-                        'domain': cookie.domain,
-                        'expirationDate': cookie.expires,
-                        # 'firstPartyDomain': ...,
-                        'httpOnly': False,
-                        'name': cookie.name,
-                        'partitionKey': None,
-                        'path': cookie.path,
-                        'sameSite': 'no_restriction',
-                        'secure': cookie.secure,
-                        'storeId': store_id,
-                        'url': f'https://{cookie.domain.lstrip(".")}{cookie.path}',
-                        'value': cookie.value,
-                    })
+            jar.load(ignore_discard=True)
+
+        cookies = [{
+            'domain': cookie.domain,
+            'expirationDate': cookie.expires,
+            # 'firstPartyDomain': ...,
+            'httpOnly': False,
+            'name': cookie.name,
+            'partitionKey': None,
+            'path': cookie.path,
+            'sameSite': 'no_restriction',
+            'secure': cookie.secure,
+            'storeId': store_id,
+            'url': f'https://{cookie.domain.lstrip(".")}{cookie.path}',
+            'value': cookie.value,
+        } for cookie in jar]
+
+        start = time.perf_counter()
+        def progress(done, total):
+            if os.isatty(sys.stderr.fileno()):
+                rate = done / (time.perf_counter() - start)
+                print(f'\rimported {done}/{total} cookies ({rate:.0f}/s)', end='', file=sys.stderr, flush=True)
+
+        errors = await client.set_cookies(cookies, batch_size=args.batch_size, window=args.window, progress=progress)
+
+        elapsed = time.perf_counter() - start
+        if os.isatty(sys.stderr.fileno()):
+            print(file=sys.stderr)
+        for cookie, error in errors:
+            print(f'failed to import {cookie["name"]} for {cookie["domain"]}{cookie["path"]}:', error.get('error', error), file=sys.stderr)
+        print(f'imported {len(cookies) - len(errors)} of {len(cookies)} cookies in {elapsed:.1f}s ({len(cookies) / elapsed:.0f}/s)', file=sys.stderr)
+        return 1 if errors else 0
 
 async def async_main(args):
     return await getattr(actions, args.CMD.replace('-', '_'))(args)
 
+SUBCOMMANDS = ('do', 'shell', 'stats', 'list', 'create', 'get', 'update', 'delete', 'status', 'user-agent', 'curl', 'http-proxy', 'with-http-proxy', 'import-cookies', 'screenshot', 'wait', 'scrape')
+
+def add_subcommand(subparsers, cmd):
+    sub = subparsers.add_parser(cmd)
+    if cmd == 'do':
+        sub.add_argument('fn', nargs='?')
+        sub.add_argument('args', nargs='*', type=parse_maybe_json)
+        sub.add_argument('--batch', action='store_true', help='Read requests as newline-delimited JSON from stdin and send them in batches')
+        sub.add_argument('--batch-size', type=int, default=1000, help='Number of requests per batch')
+        sub.add_argument('--timeout', type=float, help='Give up and stop the call in the browser after this many seconds')
+        sub.add_argument('--fields', type=lambda x: x.split(','), action='extend', help='subscribe only: comma separated paths into the event arguments to keep, e.g. 2.url')
+        sub.add_argument('--where', type=parse_where, action='append', help='subscribe only: only send events matching this, e.g. 1.status==complete, 0.url~^https: or 2.audible, can be repeated')
+    elif cmd == 'shell':
+        sub.description = 'Run requests read from stdin over one connection'
+        sub.add_argument('--max-in-flight', type=int, default=256, help='Max number of requests running at once')
+    elif cmd == 'stats':
+        sub.description = 'Show what ffcli-server has been doing'
+        sub.add_argument('-w', '--watch', type=float, nargs='?', const=1, help='Show them again every this many seconds')
+        sub.add_argument('--json', action='store_true', help='Print the raw stats as JSON')
+    elif cmd == 'list':
+        sub.add_argument('type')
+        sub.add_argument('props', nargs='*', metavar='filter')
+    elif cmd == 'create':
+        sub.add_argument('type')
+        sub.add_argument('props', nargs='*')
+    elif cmd == 'get':
+        sub.add_argument('type')
+        sub.add_argument('id', type=parse_maybe_json)
+    elif cmd == 'update':
+        sub.add_argument('type')
+        sub.add_argument('id', type=parse_maybe_json)
+        sub.add_argument('props', nargs='*')
+    elif cmd == 'delete':
+        sub.add_argument('type')
+        sub.add_argument('id', type=parse_maybe_json)
+    elif cmd == 'status':
+        pass
+    elif cmd == 'user-agent':
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('--real', action='store_true')
+        group.add_argument('--tab', type=int)
+        sub.add_argument('--refresh', action='store_true', help='Ignore the cached real user agent')
+    elif cmd == 'curl':
+        sub.add_argument('urls', nargs='*', metavar='url')
+        sub.add_argument('-K', '--url-file', '--config', default=[], action='append', help='Read urls from this file, one per line (- for stdin)')
+        sub.add_argument('-Z', '--parallel', action='store_true', help='Fetch the urls concurrently')
+        sub.add_argument('--parallel-max', type=int, default=50, help='Max urls to fetch at once with --parallel')
+        sub.add_argument('-g', '--globoff', action='store_true', help='Do not expand {a,b} and [1-10] in urls')
+        sub.add_argument('--create-dirs', action='store_true', help='Create the directories for --output')
+        sub.add_argument('-X', '--method', '--request')
+        sub.add_argument('-H', '--header', default=[], action='append')
+        sub.add_argument('-d', '--data')
+        sub.add_argument('--data-raw', dest='data')
+        sub.add_argument('-v', '--verbose', action='store_true')
+        sub.add_argument('-o', '--output', help='Write to this file instead of stdout, #1, #2, ... are replaced with the values of the globs in the url (or its position in the list)')
+        sub.add_argument('-L', '--location', action='store_true')
+        sub.add_argument('-s', '--silent', action='store_true') # not implemented
+        sub.add_argument('-S', '--show-error', action='store_true') # not implemented
+        sub.add_argument('--compressed', action='store_true') # not implemented
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('--fail', action='store_true')
+        group.add_argument('--fail-with-body', action='store_true')
+        sub.add_argument('--real-proxy', action='store_true')
+        sub.add_argument('--real-ua', action='store_true')
+        sub.add_argument('--refresh', action='store_true', help='Ignore the cached real user agent and container ids')
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('-c', '--container')
+        group.add_argument('-t', '--tab', type=int)
+    elif cmd == 'http-proxy':
+        sub.add_argument('port', default=8080, type=int, nargs='?')
+        sub.add_argument('--real-proxy', action='store_true')
+        sub.add_argument('--real-ua', action='store_true')
+        sub.add_argument('--refresh', action='store_true', help='Ignore the cached real user agent and container ids')
+        sub.add_argument('--stream-buffer', type=int, help='With --real-proxy, bytes of each response to buffer for a slow client')
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('--ignore-hosts', action='append')
+        group.add_argument('--allow-hosts', action='append')
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('-c', '--container')
+    elif cmd == 'with-http-proxy':
+        sub.add_argument('args', nargs='+')
+        sub.add_argument('-p', '--port', type=int)
+        sub.add_argument('--real-proxy', action='store_true')
+        sub.add_argument('--real-ua', action='store_true')
+        sub.add_argument('--refresh', action='store_true', help='Ignore the cached real user agent and container ids')
+        sub.add_argument('--stream-buffer', type=int, help='With --real-proxy, bytes of each response to buffer for a slow client')
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('--ignore-hosts', action='append')
+        group.add_argument('--allow-hosts', action='append')
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('-c', '--container')
+    elif cmd == 'import-cookies':
+        sub.add_argument('file')
+        sub.add_argument('-c', '--container')
+        sub.add_argument('--batch-size', type=int, default=500, help='Number of cookies to set per message')
+        sub.add_argument('--window', type=int, default=4, help='Number of batches in flight at once')
+    elif cmd == 'screenshot':
+        sub.add_argument('tab', type=int, nargs='?')
+        sub.add_argument('-f', '--format', choices=('jpeg', 'png'), default='png')
+        sub.add_argument('--scale', type=float)
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument('-s', '--selector', help='Screenshot just this css selector')
+        group.add_argument('--full', dest='selector', action='store_const', const=':root', help='Screenshot full page')
+        sub.add_argument('-o', '--output', help='Write to this file, a png taller than the window is captured in tiles and written as each one arrives')
+        sub.add_argument('--tile-height', type=int, help='Height of each tile in css pixels (default: the height of the window)')
+    elif cmd == 'scrape':
+        sub.description = 'Get properties of the nodes matching a css selector from many tabs at once, one line of JSON per tab'
+        sub.add_argument('selector')
+        sub.add_argument('keys', nargs='*', default=['textContent'], help='Properties to get from each node (default: textContent)')
+        sub.add_argument('-q', '--query', action='append', default=[], metavar='filter', help='Only tabs matching this, like in `list tabs`, e.g. -q url=*://*.example.com/*, can be repeated')
+        sub.add_argument('-j', '--jobs', type=int, default=8, help='Number of tabs to scrape at once')
+        sub.add_argument('--timeout', type=float, help='Give up on a tab after this many seconds')
+    elif cmd == 'wait':
+        sub.description = 'Wait until a css selector matches in a tab, exits with 1 if it does not in time'
+        sub.add_argument('selector')
+        sub.add_argument('tab', type=int, nargs='?')
+        sub.add_argument('--visible', action='store_true', help='Only count nodes that are visible')
+        sub.add_argument('--count', type=int, default=1, help='Wait for at least this many nodes')
+        sub.add_argument('--timeout', type=float, help='Give up after this many seconds')
+    return sub
+
 def main():
+    # only the subcommand being run needs its arguments, so find it first
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('-P', '--profile')
+    pre_parser.add_argument('--trace')
+    pre_parser.add_argument('CMD', nargs='?')
+    cmd = pre_parser.parse_known_args()[0].CMD
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-P', '--profile', default=os.environ.get('FIREFOX_PROFILE', ''))
+    parser.add_argument('--trace', metavar='FILE', help='Write a trace of every call to FILE as chrome trace event json')
     subparsers = parser.add_subparsers(dest='CMD', required=False)
-
-    sub = subparsers.add_parser('do')
-    sub.add_argument('fn')
-    sub.add_argument('args', nargs='*', type=parse_maybe_json)
-
-    sub = subparsers.add_parser('list')
-    sub.add_argument('type')
-    sub.add_argument('props', nargs='*', metavar='filter')
-
-    sub = subparsers.add_parser('create')
-    sub.add_argument('type')
-    sub.add_argument('props', nargs='*')
-
-    sub = subparsers.add_parser('get')
-    sub.add_argument('type')
-    sub.add_argument('id', type=parse_maybe_json)
-
-    sub = subparsers.add_parser('update')
-    sub.add_argument('type')
-    sub.add_argument('id', type=parse_maybe_json)
-    sub.add_argument('props', nargs='*')
-
-    sub = subparsers.add_parser('delete')
-    sub.add_argument('type')
-    sub.add_argument('id', type=parse_maybe_json)
-
-    sub = subparsers.add_parser('status')
-
-    sub = subparsers.add_parser('user-agent')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('--real', action='store_true')
-    group.add_argument('--tab', type=int)
-
-    sub = subparsers.add_parser('curl')
-    sub.add_argument('url')
-    sub.add_argument('-X', '--method', '--request')
-    sub.add_argument('-H', '--header', default=[], action='append')
-    sub.add_argument('-d', '--data')
-    sub.add_argument('--data-raw', dest='data')
-    sub.add_argument('-v', '--verbose', action='store_true')
-    sub.add_argument('-o', '--output')
-    sub.add_argument('-L', '--location', action='store_true')
-    sub.add_argument('-s', '--silent', action='store_true') # not implemented
-    sub.add_argument('-S', '--show-error', action='store_true') # not implemented
-    sub.add_argument('--compressed', action='store_true') # not implemented
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('--fail', action='store_true')
-    group.add_argument('--fail-with-body', action='store_true')
-    sub.add_argument('--real-proxy', action='store_true')
-    sub.add_argument('--real-ua', action='store_true')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('-c', '--container')
-    group.add_argument('-t', '--tab', type=int)
-
-    sub = subparsers.add_parser('http-proxy')
-    sub.add_argument('port', default=8080, type=int, nargs='?')
-    sub.add_argument('--real-proxy', action='store_true')
-    sub.add_argument('--real-ua', action='store_true')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('--ignore-hosts', action='append')
-    group.add_argument('--allow-hosts', action='append')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('-c', '--container')
-
-    sub = subparsers.add_parser('with-http-proxy')
-    sub.add_argument('args', nargs='+')
-    sub.add_argument('-p', '--port', type=int)
-    sub.add_argument('--real-proxy', action='store_true')
-    sub.add_argument('--real-ua', action='store_true')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('--ignore-hosts', action='append')
-    group.add_argument('--allow-hosts', action='append')
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('-c', '--container')
-
-    sub = subparsers.add_parser('import-cookies')
-    sub.add_argument('file')
-    sub.add_argument('-c', '--container')
-
-    sub = subparsers.add_parser('screenshot')
-    sub.add_argument('tab', type=int, nargs='?')
-    sub.add_argument('-f', '--format', choices=('jpeg', 'png'), default='png')
-    sub.add_argument('--scale', type=float)
-    group = sub.add_mutually_exclusive_group()
-    group.add_argument('-s', '--selector', help='Screenshot just this css selector')
-    group.add_argument('--full', dest='selector', action='store_const', const=':root', help='Screenshot full page')
+    for name in (cmd,) if cmd in SUBCOMMANDS else SUBCOMMANDS:
+        add_subcommand(subparsers, name)
 
     args = parser.parse_args()
     if not args.CMD:
         parser.print_help()
         return
+    if args.CMD == 'do' and not args.batch and not args.fn:
+        subparsers.choices['do'].error('the following arguments are required: fn')
+    if args.CMD == 'do' and (args.fields or args.where) and (args.batch or args.fn != 'subscribe'):
+        subparsers.choices['do'].error('--fields and --where only apply to subscribe')
 
     sys.exit(asyncio.run(async_main(args)))
 
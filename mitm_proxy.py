@@ -1,6 +1,10 @@
 import asyncio
+import contextlib
 import os
 import base64
+import secrets
+import http.client
+import logging
 from mitmproxy.http import Response
 from mitmproxy.net.http import cookies
 from mitmproxy import ctx
@@ -15,16 +19,82 @@ store_id = None
 user_agent = None
 REDIRECTS = {}
 
+# mitmproxy cannot stream responses made by addons
+# so --real-proxy flows are sent upstream to a local server that streams the response from firefox
+STREAM_HEADER = 'x-ffcli-stream'
+STREAMS = {}
+stream_server = None
+# these describe the body as the browser received it, not as fetch() returns it
+SKIP_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'connection', 'keep-alive'}
+# roughly how big each chunk of a fetch body from firefox is
+FETCH_CHUNK_SIZE = 2**16
+
+async def write_stream(response, writer):
+    try:
+        status = await response.status()
+        if 'responseHeaders' in response.response:
+            headers = [(h['name'], h['value']) for h in response.response['responseHeaders']]
+        else:
+            headers = list((await response.headers()).items())
+    except Exception:
+        logging.exception('firefox fetch failed')
+        writer.write(b'HTTP/1.1 503 Service Unavailable\r\ncontent-length: 0\r\nconnection: close\r\n\r\n')
+        return
+
+    reason = response.response.get('statusText') or http.client.responses.get(status, '')
+    head = [f'HTTP/1.1 {status} {reason}']
+    head += [f'{k}: {v}' for k, v in headers if k.lower() not in SKIP_HEADERS]
+    head += ['transfer-encoding: chunked', 'connection: close', '', '']
+    writer.write('\r\n'.join(head).encode('utf8', 'surrogateescape'))
+
+    async for data in response.read():
+        if data:
+            writer.write(b'%x\r\n' % len(data))
+            writer.write(data)
+            writer.write(b'\r\n')
+            # wait for the client to catch up
+            await writer.drain()
+    writer.write(b'0\r\n\r\n')
+
+async def handle_stream(reader, writer):
+    writer.transport.set_write_buffer_limits(high=ctx.options.firefox_stream_buffer)
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+        token = None
+        for line in head.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == STREAM_HEADER.encode():
+                token = value.strip().decode()
+        if response := STREAMS.pop(token, None):
+            await write_stream(response, writer)
+        else:
+            writer.write(b'HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\nconnection: close\r\n\r\n')
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def get_stream_server():
+    global stream_server
+    if not stream_server:
+        stream_server = await asyncio.start_server(handle_stream, '127.0.0.1', 0)
+    return stream_server.sockets[0].getsockname()[1]
+
 def done():
     if client:
+        if client.tracer:
+            client.tracer.save()
         asyncio.ensure_future(client.stop())
+    if stream_server:
+        stream_server.close()
 
 def configure(updates):
     global client
     if 'firefox_profile_dir' in updates:
         if client:
             asyncio.ensure_future(client.stop())
-        client = Client.from_profile(ctx.options.firefox_profile_dir)
+        client = Client.from_profile(ctx.options.firefox_profile_dir, cookie_cache=True, trace=ctx.options.firefox_trace)
     if 'firefox_container' in updates:
         store_id = None
 
@@ -47,6 +117,24 @@ def load(loader):
         default=False,
         help="Use real user agent from inside a tab",
     )
+    loader.add_option(
+        name="firefox_refresh",
+        typespec=bool,
+        default=False,
+        help="Ignore the real user agent and container id cached in the profile",
+    )
+    loader.add_option(
+        name="firefox_stream_buffer",
+        typespec=int,
+        default=2**20,
+        help="Bytes of a real proxy response to buffer for a slow client, both before and after it is written to the client",
+    )
+    loader.add_option(
+        name="firefox_trace",
+        typespec=Optional[str],
+        default=None,
+        help="Write a trace of every call to firefox to this file as chrome trace event json",
+    )
     loader.add_option(
         name="firefox_container",
         typespec=Optional[str],
@@ -54,7 +142,17 @@ def load(loader):
         help="Firefox container",
     )
 
+def trace(name, flow):
+    # a span around the calls made for one flow, when tracing
+    if client.tracer:
+        return client.tracer.span(f'{name} {flow.request.method} {flow.request.pretty_url}')
+    return contextlib.nullcontext()
+
 async def request(flow):
+    with trace('request', flow):
+        await _request(flow)
+
+async def _request(flow):
     global store_id
     global user_agent
 
@@ -62,16 +160,16 @@ async def request(flow):
         await client.start()
 
         if not store_id and ctx.options.firefox_container:
-            store_id = (await client.browser.contextualIdentities.query({'name': ctx.options.firefox_container}))[0]['cookieStoreId']
+            store_id = await client.get_store_id(ctx.options.firefox_container, refresh=ctx.options.firefox_refresh)
         flow.metadata['firefox_real_proxy'] = ctx.options.firefox_real_proxy
         flow.metadata['firefox_store_id'] = store_id
 
         # fetching the user agent can be expensive
-        user_agent = user_agent or (await client.get_user_agent(real=ctx.options.firefox_real_ua))
+        user_agent = user_agent or (await client.get_user_agent(real=ctx.options.firefox_real_ua, refresh=ctx.options.firefox_refresh))
         flow.request.headers['user-agent'] = user_agent
 
         if not ctx.options.firefox_real_proxy:
-            cookie_list = await client.browser.cookies.getAll({'url': flow.request.url, 'storeId': store_id, 'partitionKey': {}})
+            cookie_list = await client.get_cookies(flow.request.url, store_id, partitioned=True)
             flow.request.headers["cookie"] = '; '.join(c['name']+'='+c['value'] for c in cookie_list)
             flow.request.headers['user-agent'] = user_agent
 
@@ -88,6 +186,9 @@ async def request(flow):
                     headers = dict(flow.request.headers.items()),
                     body = flow.request.content or b'',
                     cookieStoreId = store_id,
+                    # a slow client holds up the body in firefox rather than in here,
+                    # without holding up the other flows sharing the client
+                    maxsize = max(1, ctx.options.firefox_stream_buffer // FETCH_CHUNK_SIZE),
                 )
 
                 #  if redirected := await response.redirected():
@@ -97,37 +198,56 @@ async def request(flow):
                     #  flow.response = Response.make(302, b'', {'Location': url})
                     #  return
 
-            body = b''
-            async for data in response.read():
-                body += data
-
-            flow.response = Response.make(
-                await response.status(),
-                body,
-                await response.headers(),
-            )
+            # send the flow to the stream server
+            token = secrets.token_hex(16)
+            STREAMS[token] = response
+            flow.metadata['firefox_stream'] = (token, flow.request.data.copy())
+            port = await get_stream_server()
+            flow.request.scheme = 'http'
+            flow.request.host = '127.0.0.1'
+            flow.request.port = port
+            flow.request.headers[STREAM_HEADER] = token
+            # the body has already been given to firefox
+            flow.request.content = b''
     except:
         flow.response = Response.make(503)
         raise
 
+def responseheaders(flow):
+    if stream := flow.metadata.pop('firefox_stream', None):
+        # put back the original request
+        flow.request.data = stream[1]
+        flow.response.stream = True
+
+def error(flow):
+    if stream := flow.metadata.pop('firefox_stream', None):
+        STREAMS.pop(stream[0], None)
+
 async def response(flow):
+    with trace('response', flow):
+        await _response(flow)
+
+async def _response(flow):
     if not flow.metadata.get('firefox_real_proxy'):
-        for name, (value, attrs) in flow.response.cookies.items(multi=True):
-            await client.browser.cookies.set({
-                'domain': attrs.get('Domain'),
-                'expirationDate': cookies.get_expiration_ts(attrs),
-                # 'firstPartyDomain': ...,
-                'httpOnly': 'HttpOnly' in attrs,
-                'name': name,
-                'partitionKey': None,
-                'path': attrs.get('path'),
-                'sameSite': {
-                    'none': 'no_restriction',
-                    'lax': 'lax',
-                    'strict': 'strict',
-                }.get(attrs.get('sameSite', '').lower(), 'no_restriction'),
-                'secure': 'secure' in attrs,
-                'storeId': flow.metadata.get('firefox_store_id'),
-                'url': flow.request.url,
-                'value': value,
-            })
+        cookie_list = [{
+            'domain': attrs.get('Domain'),
+            'expirationDate': cookies.get_expiration_ts(attrs),
+            # 'firstPartyDomain': ...,
+            'httpOnly': 'HttpOnly' in attrs,
+            'name': name,
+            'partitionKey': None,
+            'path': attrs.get('path'),
+            'sameSite': {
+                'none': 'no_restriction',
+                'lax': 'lax',
+                'strict': 'strict',
+            }.get(attrs.get('sameSite', '').lower(), 'no_restriction'),
+            'secure': 'secure' in attrs,
+            'storeId': flow.metadata.get('firefox_store_id'),
+            'url': flow.request.url,
+            'value': value,
+        } for name, (value, attrs) in flow.response.cookies.items(multi=True)]
+
+        if cookie_list:
+            for cookie, error in await client.set_cookies(cookie_list):
+                logging.warning('failed to set cookie %s: %s', cookie['name'], error.get('error', error))
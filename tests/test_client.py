@@ -0,0 +1,237 @@
+# end to end tests of ffcli.Client against ffcli-server and the stand-in extension in bench/
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+import ffcli
+from fake_extension import FakeExtension
+
+class Extension(FakeExtension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handlers['echo'] = self.echo
+
+    async def echo(self, msg, value):
+        return value
+
+def run_cli(*args, input=b''):
+    async def main():
+        async with FakeExtension() as ext:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(ROOT, 'ffcli.py'), '--profile', ext.profile_dir, *args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await asyncio.wait_for(proc.communicate(input), 10)
+            return proc.returncode, stdout.decode('utf8')
+    return asyncio.run(main())
+
+def run(fn, extension=Extension):
+    async def main():
+        async with extension() as ext:
+            async with ffcli.Client(ext.profile_dir) as client:
+                return await asyncio.wait_for(fn(client, ext), 10)
+    return asyncio.run(main())
+
+def test_batch():
+    async def fn(client, ext):
+        async with client.batch() as batch:
+            responses = [batch.status(), batch.id(), batch.nosuchfunction()]
+        assert await responses[0] is True
+        assert await responses[1] == 'bench@ffcli'
+        try:
+            await responses[2]
+        except ffcli.Error as e:
+            assert 'no such function' in e.args[0]['error']
+        else:
+            assert False, 'expected an error'
+    run(fn)
+
+def test_dropped_responses_are_cancelled():
+    async def fn(client, ext):
+        # dropped before it is even sent
+        client.request('sleep', [5])
+        await asyncio.sleep(0.2)
+        assert not ext.running
+        assert not client._Client__queues
+
+        # dropped while running in the browser
+        response = client.request('sleep', [5])
+        await response.get_queue()
+        await asyncio.sleep(0.1)
+        assert ext.running
+        del response
+        await asyncio.sleep(0.2)
+        assert not ext.running
+        assert not client._Client__queues
+    run(fn)
+
+def test_status_command():
+    # status reuses do without its options
+    assert run_cli('status') == (0, 'true\n')
+    assert run_cli('do', 'status') == (0, 'true\n')
+
+def test_bounded_fetch_holds_up_the_body_in_the_browser():
+    async def fn(client, ext):
+        size = 2**28
+        response = client.fetch(f'bench://{size}', maxsize=4)
+        received = 0
+        async for data in response.read():
+            received += len(data)
+            if received >= 2**20:
+                break
+            await asyncio.sleep(0.1)
+        # the server buffers a few MB for the client, but the rest is left in the browser
+        assert ext.fetched < 2**25
+    run(fn)
+
+def test_stalled_fetch_does_not_hold_up_the_others():
+    async def fn(client, ext):
+        # like two flows through the mitm proxy, one of them to a client that has stopped reading
+        stalled = client.fetch(f'bench://{2**28}', maxsize=4)
+        async for data in stalled.read():
+            break
+        size = 2**24
+        other = client.fetch(f'bench://{size}', maxsize=4)
+        received = 0
+        async for data in other.read():
+            received += len(data)
+        assert received == size
+        assert await client.status() is True
+        # the rest of the stalled body is left in the browser
+        assert ext.fetched < size + 2**23
+    run(fn)
+
+def test_replies_longer_than_the_read_limit():
+    async def fn(client, ext):
+        value = 'x' * 2**23
+        assert await client.echo(value) == value
+    run(fn)
+
+async def assert_error(response, text):
+    try:
+        await response
+    except ffcli.Error as e:
+        assert text in e.args[0]['error'], e.args[0]
+    else:
+        assert False, 'expected an error'
+
+class ShortBatchExtension(Extension):
+    async def batch(self, msg, calls):
+        return [{'type': 'data', 'data': True}]
+
+def test_batch_with_too_few_results():
+    async def fn(client, ext):
+        async with client.batch() as batch:
+            responses = [batch.status(), batch.status()]
+        for response in responses:
+            await assert_error(response, 'expected 2 results')
+    run(fn, ShortBatchExtension)
+
+def test_cancelled_batch():
+    async def fn(client, ext):
+        batch = client.batch()
+        responses = [batch.sleep(5), batch.status()]
+        task = asyncio.ensure_future(batch.send())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        for response in responses:
+            await assert_error(response, 'CancelledError')
+    run(fn)
+
+# the client shuts down the queues of unfinished requests when its connection is lost
+@pytest.mark.skipif(not hasattr(asyncio.Queue, 'shutdown'), reason='needs python 3.13')
+def test_batch_when_the_connection_is_lost():
+    async def fn(client, ext):
+        batch = client.batch()
+        responses = [batch.sleep(5), batch.status()]
+        task = asyncio.ensure_future(batch.send())
+        await asyncio.sleep(0.1)
+        ext.proc.kill()
+        for response in responses:
+            await assert_error(response, 'QueueShutDown')
+        await task
+    run(fn)
+
+def test_batch_command_with_invalid_lines():
+    code, stdout = run_cli('do', '--batch', input=b'''{"id": "a", "fn": "status"}
+{"id": "b", "args": []}
+
+not json
+[1]
+{"id": "c", "fn": "id", "args": []}
+''')
+    items = [json.loads(line) for line in stdout.splitlines()]
+    # each bad line gets an error with its line number, and the rest still run
+    assert code == 1
+    assert [(item['id'], item['type']) for item in items] == [('a', 'data'), (2, 'error'), (4, 'error'), (5, 'error'), ('c', 'data')]
+    assert "KeyError('fn')" in items[1]['data']['error']
+    assert items[4]['data'] == 'bench@ffcli'
+
+@pytest.mark.skipif(not hasattr(asyncio.Queue, 'shutdown'), reason='needs python 3.13')
+def test_shell_when_the_connection_is_lost():
+    async def main():
+        async with FakeExtension() as ext:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(ROOT, 'ffcli.py'), '--profile', ext.profile_dir, 'shell',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+            )
+            output = asyncio.ensure_future(proc.communicate(b'sleep 5\n{"id": "x", "fn": "sleep", "args": [5]}\n'))
+            await asyncio.sleep(0.5)
+            ext.proc.kill()
+            stdout, _ = await asyncio.wait_for(output, 10)
+            return stdout.decode('utf8')
+
+    items = [json.loads(line) for line in asyncio.run(main()).splitlines()]
+    # every request in flight gets an error
+    assert {item['id']: (item['type'], item.get('complete')) for item in items} == {1: ('error', True), 'x': ('error', True)}
+
+def test_read_url_file(tmp_path):
+    path = tmp_path / 'urls.txt'
+    path.write_text('''# a comment
+urls.example.com/x
+url = "https://example.com/1"
+url: https://example.com/2
+--url https://example.com/3
+
+https://example.com/4
+''')
+    assert list(ffcli.actions._read_url_file(path)) == [
+        'urls.example.com/x',
+        'https://example.com/1',
+        'https://example.com/2',
+        'https://example.com/3',
+        'https://example.com/4',
+    ]
+
+@pytest.mark.parametrize('expr,expected', [
+    ('1.status==complete', ['1.status', '==', 'complete']),
+    ('0.windowId != 1 ', ['0.windowId', '!=', 1]),
+    ('0.index<=1.5', ['0.index', '<=', 1.5]),
+    ('0.index>=2', ['0.index', '>=', 2]),
+    ('0.title<"b"', ['0.title', '<', 'b']),
+    ('0.title>"a"', ['0.title', '>', 'a']),
+    ('0.title==a==b', ['0.title', '==', 'a==b']),
+    ('0.openerTabId==null', ['0.openerTabId', '==', None]),
+    ('2.audible', ['2.audible', 'exists', True]),
+    ('!2.audible', ['2.audible', 'exists', False]),
+    ('0.tabId in [1,2]', ['0.tabId', 'in', [1, 2]]),
+    # regexes are never parsed as json
+    ('0.url~^https:', ['0.url', '~', '^https:']),
+    ('0.url ~ 1', ['0.url', '~', '1']),
+])
+def test_parse_where(expr, expected):
+    assert ffcli.parse_where(expr) == expected
+
+@pytest.mark.parametrize('expr', ['', '!', '!a==1', 'a b', 'a in', '0.tabId in[1]'])
+def test_parse_where_errors(expr):
+    with pytest.raises(argparse.ArgumentTypeError):
+        ffcli.parse_where(expr)
@@ -0,0 +1,255 @@
+# tests of ffcli.CookieCache against a stand-in extension with a cookie jar
+# every lookup is compared with what browser.cookies.getAll({url}) returns for the jar
+
+import os
+import sys
+import time
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+import ffcli
+from fake_extension import FakeExtension
+
+DEFAULT_STORE = 'firefox-default'
+
+def make_cookie(name, domain, path='/', store_id=DEFAULT_STORE, **kwargs):
+    # domain cookies start with a dot, like firefox has them
+    return {
+        'name': name,
+        'value': name + '-value',
+        'domain': domain,
+        'hostOnly': not domain.startswith('.'),
+        'path': path,
+        'secure': False,
+        'httpOnly': False,
+        'sameSite': 'no_restriction',
+        'session': True,
+        'firstPartyDomain': '',
+        'partitionKey': None,
+        'storeId': store_id,
+        **kwargs,
+    }
+
+def cookie_matches(cookie, query):
+    import urllib.parse
+    if cookie['storeId'] != (query.get('storeId') or DEFAULT_STORE):
+        return False
+    if query.get('partitionKey') is None and cookie.get('partitionKey'):
+        return False
+    if (expires := cookie.get('expirationDate')) and expires < time.time():
+        return False
+    domain = cookie['domain'].lstrip('.')
+    if (query_domain := query.get('domain')) is not None:
+        if domain != query_domain and not domain.endswith('.' + query_domain):
+            return False
+    if url := query.get('url'):
+        url = urllib.parse.urlsplit(url)
+        host, path = url.hostname, url.path or '/'
+        if cookie['hostOnly'] and host != domain:
+            return False
+        if not cookie['hostOnly'] and host != domain and not host.endswith('.' + domain):
+            return False
+        if cookie['secure'] and url.scheme != 'https':
+            return False
+        cookie_path = cookie['path']
+        if path != cookie_path and not (path.startswith(cookie_path) and (cookie_path.endswith('/') or path[len(cookie_path)] == '/')):
+            return False
+    return True
+
+class CookieExtension(FakeExtension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jar = {}
+        # subscribe requests for browser.cookies.onChanged
+        self.listeners = []
+        self.queries = []
+        # while set, getAll takes its snapshot and then waits for this before answering
+        self.hold = None
+        self.holding = asyncio.Event()
+        self.handlers['browser.cookies.getAll'] = self.get_cookies
+
+    @staticmethod
+    def key(cookie):
+        return (cookie['storeId'], cookie['domain'], cookie['name'], cookie['path'], str(cookie.get('partitionKey')))
+
+    def change(self, cookie, removed=False):
+        if removed:
+            self.jar.pop(self.key(cookie))
+        else:
+            self.jar[self.key(cookie)] = cookie
+        for msg in self.listeners:
+            self.send(msg, [{'removed': removed, 'cookie': cookie, 'cause': 'explicit'}])
+
+    async def get_cookies(self, msg, query):
+        self.queries.append(query)
+        cookies = [c for c in self.jar.values() if cookie_matches(c, query)]
+        if self.hold:
+            self.holding.set()
+            await self.hold.wait()
+        return cookies
+
+    async def subscribe(self, msg, event, *args):
+        assert event == 'browser.cookies.onChanged'
+        self.send(msg, {'subscriptionId': 'cookies'})
+        self.listeners.append(msg)
+        await asyncio.Future()
+
+def run(fn, **cache_args):
+    async def main():
+        async with CookieExtension() as ext:
+            async with ffcli.Client(ext.profile_dir, cookie_cache=cache_args or True) as client:
+                return await asyncio.wait_for(fn(client, ext), 10)
+    return asyncio.run(main())
+
+async def settle(client):
+    # changes are sent before the reply to this, give the cache a moment to apply them
+    await client.status()
+    await asyncio.sleep(0.01)
+
+def sort(cookies):
+    return sorted(cookies, key=CookieExtension.key)
+
+async def assert_same(client, url, store_id=None, partitioned=False):
+    query = {'url': url, 'storeId': store_id}
+    if partitioned:
+        query['partitionKey'] = {}
+    expected = await client.browser.cookies.getAll(query)
+    cookies = await client.get_cookies(url, store_id, partitioned)
+    assert sort(cookies) == sort(expected), url
+    # longer paths first
+    assert [len(c['path']) for c in cookies] == sorted((len(c['path']) for c in cookies), reverse=True)
+    return cookies
+
+URLS = [
+    'https://example.com/',
+    'http://example.com/',
+    'https://example.com/a',
+    'https://example.com/a/',
+    'https://example.com/a/b',
+    'https://example.com/ab',
+    'https://a.example.com/a/b',
+    'http://a.example.com/a/b',
+    'https://b.a.example.com/a/',
+    'https://example.org/',
+    'https://notexample.com/',
+    'https://com/',
+]
+
+JAR = [
+    make_cookie('host', 'example.com'),
+    make_cookie('domain', '.example.com', '/a'),
+    make_cookie('dir', '.example.com', '/a/'),
+    make_cookie('secure', 'a.example.com', '/a/', secure=True),
+    make_cookie('subdomain', '.a.example.com'),
+    make_cookie('expired', '.example.com', expirationDate=time.time() - 100),
+    make_cookie('persistent', '.example.com', expirationDate=time.time() + 3600, session=False),
+    make_cookie('partitioned', '.example.com', partitionKey={'topLevelSite': 'https://example.org'}),
+    make_cookie('org', 'example.org'),
+    make_cookie('container', 'example.com', store_id='firefox-container-1'),
+]
+
+def test_matches_getall():
+    async def fn(client, ext):
+        for cookie in JAR:
+            ext.change(cookie)
+        for url in URLS:
+            await assert_same(client, url)
+            await assert_same(client, url, partitioned=True)
+            await assert_same(client, url, 'firefox-container-1')
+        # one snapshot per store, the rest are hits
+        assert [q for q in ext.queries if 'url' not in q] == [
+            {'storeId': None, 'partitionKey': {}},
+            {'storeId': 'firefox-container-1', 'partitionKey': {}},
+        ]
+        assert client.cookie_cache.stats()['misses'] == 2
+    run(fn)
+
+def test_follows_changes():
+    async def fn(client, ext):
+        for cookie in JAR:
+            ext.change(cookie)
+        await assert_same(client, 'https://example.com/a')
+
+        ext.change(make_cookie('new', '.example.com'))
+        ext.change(JAR[1], removed=True)
+        ext.change({**JAR[0], 'value': 'changed'})
+        await settle(client)
+        for url in URLS:
+            await assert_same(client, url)
+        assert len([q for q in ext.queries if 'url' not in q]) == 1
+    run(fn)
+
+def test_changes_while_loading():
+    async def fn(client, ext):
+        ext.change(JAR[0])
+        ext.change(JAR[1])
+        ext.hold = asyncio.Event()
+        lookup = asyncio.ensure_future(client.get_cookies('https://example.com/a'))
+        await ext.holding.wait()
+        # after the snapshot was taken but before it arrives
+        ext.change(JAR[1], removed=True)
+        ext.change(make_cookie('new', '.example.com'))
+        await settle(client)
+        ext.hold.set()
+        ext.hold = None
+        await lookup
+        for url in URLS:
+            await assert_same(client, url)
+    run(fn)
+
+def test_concurrent_lookups_load_once():
+    async def fn(client, ext):
+        for cookie in JAR:
+            ext.change(cookie)
+        await asyncio.gather(*(assert_same(client, url) for url in URLS))
+        assert len([q for q in ext.queries if 'url' not in q]) == 1
+    run(fn)
+
+def test_default_store_found_later():
+    async def fn(client, ext):
+        # an empty default store does not tell us its id
+        assert await assert_same(client, 'https://example.com/') == []
+        ext.change(JAR[0])
+        await settle(client)
+        # so a change to any store may be a change to it
+        assert await assert_same(client, 'https://example.com/') == [JAR[0]]
+        ext.change(JAR[-1])
+        ext.change(make_cookie('new', '.example.com'))
+        await settle(client)
+        for url in URLS:
+            await assert_same(client, url)
+            await assert_same(client, url, 'firefox-container-1')
+    run(fn)
+
+def test_eviction_and_refetch():
+    async def fn(client, ext):
+        domains = [f'site{i}.example' for i in range(5)]
+        for domain in domains:
+            ext.change(make_cookie('a', domain))
+            ext.change(make_cookie('b', domain))
+        for domain in domains:
+            await assert_same(client, f'https://{domain}/')
+        stats = client.cookie_cache.stats()
+        assert stats['size'] <= 4 and stats['evictions'] > 0
+
+        # evicted domains are fetched again, and changes to them are not lost
+        ext.change(make_cookie('c', domains[0]))
+        ext.change(make_cookie('b', domains[0]), removed=True)
+        await settle(client)
+        for domain in domains:
+            await assert_same(client, f'https://{domain}/')
+        assert {'storeId': DEFAULT_STORE, 'domain': domains[0], 'partitionKey': {}} in ext.queries
+        assert client.cookie_cache.stats()['size'] <= 4
+    run(fn, max_cookies=4)
+
+def test_expires_while_cached():
+    async def fn(client, ext):
+        ext.change(make_cookie('soon', '.example.com', expirationDate=time.time() + 0.2, session=False))
+        ext.change(JAR[0])
+        assert len(await assert_same(client, 'https://example.com/')) == 2
+        await asyncio.sleep(0.3)
+        # firefox drops it without telling us
+        assert await assert_same(client, 'https://example.com/') == [JAR[0]]
+    run(fn)
@@ -0,0 +1,193 @@
+# tests of ffcli.HttpPool and fake_fetch against a small local http server
+
+import os
+import sys
+import asyncio
+import urllib.parse
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+import ffcli
+from fake_extension import FakeExtension
+
+BODY = b'hello world'
+
+# path -> (raw response, whether the server then closes the connection)
+ROUTES = {
+    '/length': (b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n' + BODY, False),
+    '/chunked': (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n', False),
+    '/close': (b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n' + BODY, True),
+    '/http10': (b'HTTP/1.0 200 OK\r\nContent-Length: 11\r\n\r\n' + BODY, True),
+    '/continue': (b'HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 204 No Content\r\n\r\n', False),
+    '/login': (b'HTTP/1.1 303 See Other\r\nLocation: /home\r\nSet-Cookie: session=abc; Path=/\r\nContent-Length: 0\r\n\r\n', False),
+    '/elsewhere': (b'HTTP/1.1 302 Found\r\nLocation: /login\r\nSet-Cookie: theme=dark; Path=/\r\nContent-Length: 0\r\n\r\n', False),
+}
+
+class Server:
+    def __init__(self):
+        self.connections = 0
+        # (method, path, headers, body)
+        self.requests = []
+        # close connections on their second request without answering, like a server dropping idle connections
+        self.drop_reused = False
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.url = 'http://127.0.0.1:%d' % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        served = 0
+        try:
+            while True:
+                head = (await reader.readuntil(b'\r\n\r\n')).decode('iso-8859-1').split('\r\n')
+                method, path, _ = head[0].split(' ')
+                headers = dict(line.split(': ', 1) for line in head[1:] if line)
+                body = await reader.readexactly(int(headers.get('Content-Length', 0)))
+                self.requests.append((method, path, headers, body))
+                if served and self.drop_reused:
+                    break
+
+                if path == '/home':
+                    cookie = headers.get('Cookie', '').encode('iso-8859-1')
+                    response, close = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(cookie), cookie), False
+                else:
+                    response, close = ROUTES[path]
+                if method == 'HEAD':
+                    response = response.partition(b'\r\n\r\n')[0] + b'\r\n\r\n'
+                writer.write(response)
+                await writer.drain()
+                served += 1
+                if close:
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+def run(fn, **pool_args):
+    async def main():
+        pool = ffcli.HttpPool(**pool_args)
+        try:
+            async with Server() as server:
+                return await asyncio.wait_for(fn(pool, server), 10)
+        finally:
+            pool.close()
+    return asyncio.run(main())
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch):
+    monkeypatch.setenv('no_proxy', '*')
+
+async def get(pool, server, path, method='GET', body=b'', size=2**16):
+    response = await pool.request(method, server.url + path, body=body)
+    try:
+        return response, [data async for data in response.read(size)]
+    finally:
+        response.release()
+
+def test_bodies():
+    async def fn(pool, server):
+        response, chunks = await get(pool, server, '/chunked', size=3)
+        assert b''.join(chunks) == BODY
+        assert max(map(len, chunks)) == 3
+
+        response, chunks = await get(pool, server, '/length')
+        assert b''.join(chunks) == BODY
+        assert response.status == 200 and response.get('content-length') == '11'
+
+        response, chunks = await get(pool, server, '/close')
+        assert b''.join(chunks) == BODY
+
+        # no body, the headers are skipped along with the 100
+        response, chunks = await get(pool, server, '/continue')
+        assert (response.status, chunks) == (204, [])
+        response, chunks = await get(pool, server, '/length', 'HEAD')
+        assert (response.status, chunks) == (200, [])
+    run(fn)
+
+def test_connection_reuse():
+    async def fn(pool, server):
+        for path in ('/length', '/chunked', '/continue'):
+            await get(pool, server, path)
+        await get(pool, server, '/length', 'HEAD')
+        assert pool.stats() == dict(opened=1, reused=3, idle=1)
+
+        # not reused after a body that ends with the connection, or an http/1.0 one without keep-alive
+        for path in ('/close', '/http10', '/length'):
+            await get(pool, server, path)
+        assert pool.stats() == dict(opened=3, reused=4, idle=1)
+        assert server.connections == 3
+
+        # nor after a body that was not read to the end
+        response = await pool.request('GET', server.url + '/length')
+        response.release()
+        await get(pool, server, '/length')
+        assert pool.stats() == dict(opened=4, reused=5, idle=1)
+
+        # at once, each gets its own connection and all are kept
+        await asyncio.gather(*(get(pool, server, '/length') for i in range(3)))
+        assert pool.stats()['idle'] == 3
+        assert server.connections == 6
+    run(fn)
+
+def test_retry_on_a_stale_connection():
+    async def fn(pool, server):
+        await get(pool, server, '/length')
+        server.drop_reused = True
+        # retried once on a new connection
+        response, chunks = await get(pool, server, '/length')
+        assert b''.join(chunks) == BODY
+        assert pool.stats() == dict(opened=2, reused=1, idle=1)
+        assert [r[1] for r in server.requests] == ['/length'] * 3
+
+        # but never for a request that is not safe to repeat
+        server.requests.clear()
+        with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+            await get(pool, server, '/length', 'POST', b'x=1')
+        assert [r[0] for r in server.requests] == ['POST']
+        # and the connection to the host is given back
+        server.drop_reused = False
+        response, chunks = await get(pool, server, '/length')
+        assert b''.join(chunks) == BODY
+    run(fn, max_per_host=1)
+
+class CookieJarExtension(FakeExtension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # name -> cookie, all for the one host
+        self.jar = {}
+        self.handlers['browser.cookies.set'] = self.set_cookie
+
+    async def get_cookies(self, msg, query):
+        host = urllib.parse.urlsplit(query['url']).hostname
+        return [c for c in self.jar.values() if c['domain'] == host]
+
+    async def set_cookie(self, msg, cookie):
+        self.jar[cookie['name']] = {**cookie, 'domain': urllib.parse.urlsplit(cookie['url']).hostname, 'path': cookie['path'] or '/'}
+
+def test_cookies_across_redirects():
+    async def main():
+        async with Server() as server, CookieJarExtension() as ext:
+            async with ffcli.Client(ext.profile_dir) as client:
+                response = client.fake_fetch(server.url + '/elsewhere', 'POST', {'Content-Type': 'text/plain'}, b'x')
+                events = [event async for event in response.iter()]
+                return server.requests, events, ext.jar
+
+    requests, events, jar = asyncio.run(asyncio.wait_for(main(), 10))
+    # a 302 after a POST and then a 303 both turn into a GET without the body
+    assert [(method, path, body) for method, path, _, body in requests] == [('POST', '/elsewhere', b'x'), ('GET', '/login', b''), ('GET', '/home', b'')]
+    assert 'Content-Type' not in requests[1][2]
+    # each hop sends the cookies set by the ones before it
+    assert 'Cookie' not in requests[0][2]
+    assert requests[1][2]['Cookie'] == 'theme=dark'
+    assert sorted(requests[2][2]['Cookie'].split('; ')) == ['session=abc', 'theme=dark']
+    assert {name: cookie['value'] for name, cookie in jar.items()} == {'theme': 'dark', 'session': 'abc'}
+    assert [data['statusCode'] for type, data in events if type == 'headersReceived'] == [302, 303, 200]
+    assert b''.join(data for type, data in events if type == 'responseBody') == requests[2][2]['Cookie'].encode('iso-8859-1')
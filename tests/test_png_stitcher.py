@@ -0,0 +1,113 @@
+# tests of ffcli.PngStitcher with synthetic tiles, decoded again and compared pixel by pixel
+
+import io
+import os
+import sys
+import zlib
+import random
+import struct
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+import ffcli
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+def predict(kind, row, prev, i, bpp):
+    a = row[i - bpp] if i >= bpp else 0
+    b = prev[i]
+    c = prev[i - bpp] if i >= bpp else 0
+    return (0, a, b, (a + b) // 2, paeth(a, b, c))[kind]
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def encode(rows, width, depth, colour, filters):
+    # rows are the raw bytes of each row, each filtered with the next of filters
+    bpp = max(1, ffcli.PngStitcher.CHANNELS[colour] * depth // 8)
+    data = bytearray()
+    prev = bytes(len(rows[0]))
+    for row, kind in zip(rows, filters):
+        data.append(kind)
+        data += bytes((x - predict(kind, row, prev, i, bpp)) & 0xff for i, x in enumerate(row))
+        prev = row
+    header = struct.pack('>IIBBBBB', width, len(rows), depth, colour, 0, 0, 0)
+    # split over a few IDAT chunks like browsers do for big images
+    data = zlib.compress(bytes(data))
+    idat = b''.join(chunk(b'IDAT', data[i:i + 50]) for i in range(0, len(data), 50))
+    return SIGNATURE + chunk(b'IHDR', header) + idat + chunk(b'IEND', b'')
+
+def decode(png):
+    # returns the IHDR fields and the raw bytes of each row
+    assert png.startswith(SIGNATURE)
+    pos = len(SIGNATURE)
+    kinds = []
+    data = b''
+    while pos < len(png):
+        length, kind = struct.unpack_from('>I4s', png, pos)
+        body = png[pos + 8 : pos + 8 + length]
+        assert struct.unpack_from('>I', png, pos + 8 + length)[0] == zlib.crc32(kind + body)
+        kinds.append(kind)
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == b'IDAT':
+            data += body
+        pos += 12 + length
+    assert kinds[0] == b'IHDR' and kinds[-1] == b'IEND'
+
+    width, height, depth, colour = header[:4]
+    bits = ffcli.PngStitcher.CHANNELS[colour] * depth
+    bpp, stride = max(1, bits // 8), (width * bits + 7) // 8
+    data = zlib.decompress(data)
+    assert len(data) == height * (stride + 1)
+    rows = []
+    prev = bytes(stride)
+    for y in range(height):
+        kind, row = data[y * (stride + 1)], bytearray(data[y * (stride + 1) + 1 : (y + 1) * (stride + 1)])
+        for i in range(stride):
+            row[i] = (row[i] + predict(kind, row, prev, i, bpp)) & 0xff
+        rows.append(bytes(row))
+        prev = row
+    return header, rows
+
+@pytest.mark.parametrize('depth,colour', [(8, 2), (8, 6), (8, 0), (16, 2), (1, 0)])
+def test_stitch(depth, colour):
+    rand = random.Random(depth * 10 + colour)
+    width, tile_height, height = 7, 5, 22
+    stride = (width * ffcli.PngStitcher.CHANNELS[colour] * depth + 7) // 8
+    rows = [bytes(rand.randrange(256) for i in range(stride)) for y in range(height)]
+
+    file = io.BytesIO()
+    stitcher = ffcli.PngStitcher(file)
+    for i, y in enumerate(range(0, height, tile_height)):
+        tile = rows[y:y + tile_height]
+        # every filter type shows up as the first row of some tile, the last tile is shorter
+        filters = [(j + 2 * i) % 5 for j in range(len(tile))]
+        stitcher.add(encode(tile, width, depth, colour, filters))
+    stitcher.close()
+
+    header, stitched = decode(file.getvalue())
+    assert header == (width, height, depth, colour, 0, 0, 0)
+    assert stitched == rows
+
+def test_mismatched_tiles():
+    tile = encode([bytes(21)], 7, 8, 2, [0])
+    stitcher = ffcli.PngStitcher(io.BytesIO())
+    stitcher.add(tile)
+    with pytest.raises(ValueError):
+        stitcher.add(encode([bytes(24)], 8, 8, 2, [0]))
+    with pytest.raises(ValueError):
+        stitcher.add(encode([bytes(28)], 7, 8, 6, [0]))
+    # palettes are not supported
+    with pytest.raises(ValueError):
+        ffcli.PngStitcher(io.BytesIO()).add(tile.replace(b'\x08\x02\x00\x00\x00', b'\x08\x03\x00\x00\x00'))
+    with pytest.raises(ValueError):
+        ffcli.PngStitcher(io.BytesIO()).add(b'not a png')
@@ -0,0 +1,147 @@
+# tests of the overflow policies of ffcli.ReplyQueue
+
+import os
+import sys
+import asyncio
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+import ffcli
+
+def data(value):
+    return {'type': 'data', 'data': value}
+
+FIRST = data({'subscriptionId': 'sub'})
+ERROR = {'type': 'error', 'data': {'error': 'failed'}}
+FINAL = {'type': 'data', 'data': None, 'complete': True}
+
+def run(fn):
+    return asyncio.run(asyncio.wait_for(fn(), 5))
+
+def contents(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        ffcli.ReplyQueue(overflow='nope')
+    with pytest.raises(ValueError):
+        ffcli.ReplyQueue(overflow='coalesce')
+
+def test_block():
+    async def fn():
+        queue = ffcli.ReplyQueue(2)
+        await queue.put(FIRST)
+        await queue.put(data(1))
+        put = asyncio.ensure_future(queue.put(data(2)))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+        assert queue.blocked == 1
+        assert queue.get_nowait() is FIRST
+        await put
+        assert contents(queue) == [data(1), data(2)]
+        assert queue.stats() == dict(size=0, dropped=0, coalesced=0, blocked=1, pauses=0)
+    run(fn)
+
+def test_drop_newest():
+    async def fn():
+        queue = ffcli.ReplyQueue(3, 'drop_newest')
+        for item in [FIRST, *map(data, range(5))]:
+            await queue.put(item)
+        # never blocks, and the first reply always stays
+        assert queue.qsize() == 3
+        assert queue.dropped == 3
+        await queue.put(ERROR)
+        await queue.put(FINAL)
+        await queue.put(None)
+        assert contents(queue) == [FIRST, data(0), data(1), ERROR, FINAL, None]
+    run(fn)
+
+def test_drop_oldest():
+    async def fn():
+        queue = ffcli.ReplyQueue(3, 'drop_oldest')
+        await queue.put(FIRST)
+        await queue.put(data(0))
+        await queue.put(ERROR)
+        for i in range(1, 5):
+            queue.put_nowait(data(i))
+        assert queue.dropped == 4
+        # the oldest droppable reply goes, not the first one or errors
+        await queue.put(FINAL)
+        assert contents(queue) == [FIRST, ERROR, data(4), FINAL]
+    run(fn)
+
+def test_coalesce():
+    async def fn():
+        queue = ffcli.ReplyQueue(4, 'coalesce', key=lambda args: args[0])
+        await queue.put(data([1, 'first']))
+        for item in (data([1, 'a']), data([2, 'a']), data([1, 'b']), data([2, 'b']), data([1, 'c'])):
+            await queue.put(item)
+        assert queue.coalesced == 3
+        # the first reply is not coalesced, and the others keep their place in the queue
+        assert contents(queue) == [data([1, 'first']), data([1, 'c']), data([2, 'b'])]
+
+        # once an event has been taken, the next one with its key is queued again
+        await queue.put(data([1, 'd']))
+        assert contents(queue) == [data([1, 'd'])]
+
+        # errors and the final reply are never merged
+        await queue.put(data([3, 'a']))
+        await queue.put({'type': 'error', 'data': [3, 'error']})
+        await queue.put({**data([3, 'b']), 'complete': True})
+        assert queue.qsize() == 3
+
+        # with nothing to replace it blocks
+        await queue.put(data([4, 'a']))
+        put = asyncio.ensure_future(queue.put(data([5, 'a'])))
+        await asyncio.sleep(0.01)
+        assert queue.blocked == 1 and not put.done()
+        queue.get_nowait()
+        await put
+        assert queue.qsize() == 4
+    run(fn)
+
+def test_coalesce_key_errors():
+    async def fn():
+        queue = ffcli.ReplyQueue(4, 'coalesce', key=lambda args: args['id'])
+        for item in (FIRST, data([1]), data([1])):
+            await queue.put(item)
+        # keys that fail are queued as they are
+        assert queue.coalesced == 0 and queue.qsize() == 3
+    run(fn)
+
+def test_pause():
+    async def fn():
+        queue = ffcli.ReplyQueue(4, 'pause')
+        flow = []
+        queue.flow = flow.append
+        for i in range(6):
+            # never blocks
+            await queue.put(data(i))
+        assert flow == [True]
+        assert queue.paused and queue.pauses == 1
+        queue.get_nowait()
+        queue.get_nowait()
+        queue.get_nowait()
+        assert flow == [True]
+        # resumed once it is down to half
+        queue.get_nowait()
+        assert flow == [True, False]
+        assert not queue.paused
+        await queue.put(data(6))
+        await queue.put(data(7))
+        assert flow == [True, False, True]
+        assert queue.stats() == dict(size=4, dropped=0, coalesced=0, blocked=0, pauses=2)
+    run(fn)
+
+def test_unbounded():
+    async def fn():
+        for overflow in ffcli.ReplyQueue.OVERFLOW:
+            queue = ffcli.ReplyQueue(0, overflow, key=lambda args: args[0])
+            for i in range(100):
+                await queue.put(data([i]))
+            assert queue.stats() == dict(size=100, dropped=0, coalesced=0, blocked=0, pauses=0), overflow
+    run(fn)
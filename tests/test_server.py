@@ -0,0 +1,404 @@
+# tests of ffcli-server talking to raw socket clients and the stand-in extension in bench/
+
+import os
+import sys
+import json
+import base64
+import time
+import asyncio
+import importlib.util
+import importlib.machinery
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+from fake_extension import FakeExtension
+
+def load_server():
+    loader = importlib.machinery.SourceFileLoader('ffcli_server', os.path.join(ROOT, 'ffcli-server'))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+server = load_server()
+
+class Extension(FakeExtension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handlers['whoami'] = self.whoami
+
+    async def whoami(self, msg):
+        return msg['_id']
+
+def run(fn, **kwargs):
+    async def main():
+        async with Extension(**kwargs) as ext:
+            reader, writer = await asyncio.open_unix_connection(ext.socket_path)
+            try:
+                return await asyncio.wait_for(fn(reader, writer), 10)
+            finally:
+                writer.close()
+    return asyncio.run(main())
+
+async def call(reader, writer, line):
+    writer.write(line + b'\n')
+    await writer.drain()
+    return json.loads(await reader.readline())['data']
+
+def test_clients_cannot_choose_their_connection_id():
+    async def fn(reader, writer):
+        own = await call(reader, writer, b'{"id":1,"fn":"whoami","args":[]}')
+        for line in (
+            b'{"id":2,"fn":"whoami","args":[],"_id":999}',
+            b'{"id":3,"fn":"whoami","args":[],"\\u005fid":999}',
+            b'{"id":4,"fn":"whoami","args":[],"_i\\u0064":999}',
+            # the slow path
+            b'{"fn":"whoami","id":5,"args":[],"_id":999}',
+            b'{"_id":999,"fn":"whoami","id":6,"args":[]}',
+        ):
+            assert await call(reader, writer, line) == own, line
+    run(fn)
+
+def test_replies_to_ids_the_header_cannot_split():
+    async def fn(reader, writer):
+        for id in ('a],b', '],', 'a]', 'a],\\"b'):
+            writer.write(json.dumps({'id': id, 'fn': 'status', 'args': []}).encode('utf8') + b'\n')
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            assert reply == {'id': id, 'type': 'data', 'data': True, 'complete': True}
+    run(fn)
+    # older extensions without the header
+    run(fn, legacy=True)
+
+def test_binary_body_replies():
+    body = bytes(range(256)) * 100
+    item = {'id': 3, 'type': 'data', 'data': {'type': 'responseBody', 'data': base64.b64encode(body).decode('ascii')}}
+    expected = b'{"id": 3, "type": "data", "data": {"type": "responseBody", "data": null}, "binary": %d}\n' % len(body) + body
+
+    for payload in (
+        # as sent by the extension
+        json.dumps(item, separators=(',', ':')).encode('utf8'),
+        # re-encoded by the server
+        json.dumps(item).encode('utf8'),
+    ):
+        header, _, rest = server.encode_reply(server.Reply(3, False, payload), True).partition(b'\n')
+        assert json.loads(header) == json.loads(expected.partition(b'\n')[0])
+        assert rest == body
+
+    # anything else is passed through
+    for item in (
+        {'id': 3, 'type': 'data', 'data': {'type': 'response', 'data': {'status': 200}}},
+        {'id': 3, 'type': 'data', 'data': 'responseBody'},
+        {'id': 3, 'type': 'data', 'data': {'type': 'responseBody', 'data': 'not base64!'}},
+    ):
+        payload = json.dumps(item, separators=(',', ':')).encode('utf8')
+        assert server.encode_reply(server.Reply(3, False, payload), True) == payload + b'\n'
+        assert server.encode_reply(server.Reply(3, False, payload), False) == payload + b'\n'
+
+def test_client_and_server_pause_independently():
+    conn = server.Connection(1)
+    control = server.scheduler.control
+    control.clear()
+    sent = lambda: [json.loads(data)['type'] for data in control]
+
+    conn.pause(5, by_client=True)
+    # the server catching up does not resume what the client still holds
+    conn.pause(5)
+    conn.resume(5)
+    assert sent() == ['pause']
+    conn.resume(5, by_client=True)
+    assert sent() == ['pause', 'resume']
+    # resuming something that is not paused does nothing
+    conn.resume(5, by_client=True)
+    assert sent() == ['pause', 'resume']
+    control.clear()
+
+def drain(scheduler):
+    sent = []
+    while (data := scheduler._next()) is not None:
+        sent.append(data)
+    return sent
+
+def put_all(scheduler, requests):
+    async def main():
+        for conn_id, data in requests:
+            await scheduler.put(conn_id, None, data)
+    asyncio.run(main())
+
+def test_scheduler_takes_turns():
+    scheduler = server.Scheduler(quantum=10)
+    put_all(scheduler, [(1, b'a%d-------' % i) for i in range(4)] + [(2, b'b%d-------' % i) for i in range(2)])
+    assert [data[:2] for data in drain(scheduler)] == [b'a0', b'b0', b'a1', b'b1', b'a2', b'a3']
+
+def test_scheduler_shares_bytes_not_requests():
+    scheduler = server.Scheduler(quantum=10)
+    # a big request costs as many turns as the small ones that add up to it
+    put_all(scheduler, [(1, b'A' * 30)] * 2 + [(2, b'b' * 10)] * 6)
+    assert b''.join(data[:1] for data in drain(scheduler)) == b'bbAbbbAb'
+
+def test_scheduler_weights():
+    scheduler = server.Scheduler(quantum=10)
+    server.set_weight(server.Connection(1), 2)
+    try:
+        put_all(scheduler, [(1, b'a' * 10)] * 6 + [(2, b'b' * 10)] * 3)
+        # the weights are per server, not per scheduler
+        scheduler.weights = server.scheduler.weights
+        assert b''.join(data[:1] for data in drain(scheduler)) == b'aabaabaab'
+    finally:
+        server.scheduler.weights.clear()
+    assert server.set_weight(server.Connection(1), 0) == 0.01
+    server.scheduler.weights.clear()
+
+def test_scheduler_control_lane():
+    scheduler = server.Scheduler(quantum=10)
+    put_all(scheduler, [(1, b'request 1')] * 2)
+    scheduler.put_control(b'cancel')
+    assert drain(scheduler) == [b'cancel', b'request 1', b'request 1']
+
+def test_scheduler_cancel_and_remove():
+    scheduler = server.Scheduler(quantum=10)
+    async def main():
+        await scheduler.put(1, 'x', b'x')
+        await scheduler.put(1, 'y', b'y')
+        await scheduler.put(2, 'z', b'z')
+    asyncio.run(main())
+    assert scheduler.cancel(1, 'x')
+    assert not scheduler.cancel(1, 'x')
+    scheduler.remove(2)
+    assert drain(scheduler) == [b'y']
+    assert not scheduler.queued[1]
+
+def test_light_client_latency_with_a_heavy_client():
+    import fairness
+    size, in_flight = 2**16, 128
+
+    async def main():
+        async with Extension() as ext:
+            stop = asyncio.Event()
+            start = time.perf_counter()
+            heavy = asyncio.create_task(fairness.heavy_client(ext.socket_path, size, in_flight, stop))
+            # let it fill up the pipe
+            await asyncio.sleep(0.5)
+            # an unfair server can hold it up forever
+            latencies = sorted(await asyncio.wait_for(fairness.light_client(ext.socket_path, 100, 0.005), 30))
+            stop.set()
+            sent = await heavy
+            return latencies, sent * size / (time.perf_counter() - start)
+
+    latencies, throughput = asyncio.run(main())
+    # first come first served, each light request would wait for everything the heavy client has queued
+    fifo = in_flight * size / throughput
+    assert latencies[98] < fifo / 2, (latencies[98], fifo)
+
+class SubscribeExtension(Extension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # subscribe requests for listeners that are still in place
+        self.listeners = []
+
+    async def subscribe(self, msg, event, num_events=None, *args):
+        self.send(msg, {'subscriptionId': 'browser'})
+        self.listeners.append(msg)
+        # like the extension, the listener stays until its connection is disconnected
+        while msg['_id'] not in self.disconnected:
+            await asyncio.sleep(0.01)
+        self.listeners.remove(msg)
+
+    def emit(self, data):
+        for msg in self.listeners:
+            self.send(msg, data)
+
+async def read_reply(reader):
+    return json.loads(await reader.readline())
+
+def run_clients(fn, count):
+    async def main():
+        async with SubscribeExtension() as ext:
+            clients = [await asyncio.open_unix_connection(ext.socket_path) for i in range(count)]
+            try:
+                return await asyncio.wait_for(fn(ext, *clients), 10)
+            finally:
+                for reader, writer in clients:
+                    writer.close()
+    return asyncio.run(main())
+
+async def subscribe(reader, writer, id, **kwargs):
+    writer.write(json.dumps({'id': id, 'fn': 'subscribe', 'args': ['browser.tabs.onUpdated'], **kwargs}).encode('utf8') + b'\n')
+    await writer.drain()
+    reply = await read_reply(reader)
+    assert reply['id'] == id and not reply.get('complete'), reply
+    return reply['data']['subscriptionId']
+
+def test_shared_subscription():
+    async def fn(ext, a, b):
+        sub_a = await subscribe(*a, 1)
+        sub_b = await subscribe(*b, 7)
+        # one listener in the browser, but each client gets its own subscription id
+        assert len(ext.listeners) == 1
+        assert sub_a != sub_b and 'browser' not in (sub_a, sub_b)
+
+        ext.emit(['event 1'])
+        assert await read_reply(a[0]) == {'id': 1, 'type': 'data', 'data': ['event 1']}
+        assert await read_reply(b[0]) == {'id': 7, 'type': 'data', 'data': ['event 1']}
+
+        # the other client's subscription id is not ours to unsubscribe
+        assert await call(*a, json.dumps({'id': 2, 'fn': 'unsubscribe', 'args': [sub_b]}).encode('utf8')) is None
+        a[1].write(json.dumps({'id': 3, 'fn': 'unsubscribe', 'args': [sub_a]}).encode('utf8') + b'\n')
+        assert await read_reply(a[0]) == {'id': 1, 'type': 'data', 'data': None, 'complete': True}
+        assert await read_reply(a[0]) == {'id': 3, 'type': 'data', 'data': None, 'complete': True}
+        # still wanted by the other client
+        assert await call(*a, b'{"id":4,"fn":"status","args":[]}') is True
+        assert len(ext.listeners) == 1 and not ext.disconnected
+
+        ext.emit(['event 2'])
+        assert await read_reply(b[0]) == {'id': 7, 'type': 'data', 'data': ['event 2']}
+        assert await call(*a, b'{"id":5,"fn":"status","args":[]}') is True
+
+        # the last client leaving removes the listener
+        b[1].close()
+        while ext.listeners:
+            await asyncio.sleep(0.01)
+
+        # and the next subscriber starts a new one
+        await subscribe(*a, 6)
+        assert len(ext.listeners) == 1
+    run_clients(fn, 2)
+
+def test_cancel_a_subscription_straight_away():
+    async def fn(ext, a):
+        a[1].write(b'{"id":1,"fn":"subscribe","args":["browser.tabs.onUpdated"]}\n{"id":1,"type":"cancel"}\n')
+        assert await read_reply(a[0]) == {'id': 1, 'type': 'data', 'data': None, 'complete': True}
+        while ext.listeners or not ext.disconnected:
+            await asyncio.sleep(0.01)
+    run_clients(fn, 1)
+
+def test_subscriptions_with_different_options_are_not_shared():
+    async def fn(ext, *clients):
+        await subscribe(*clients[0], 1)
+        await subscribe(*clients[1], 1, fields=['tabId'])
+        await subscribe(*clients[2], 1, where='0.status==complete')
+        await subscribe(*clients[3], 1, fields=['tabId'], where='0.status==complete')
+        # the same as the first
+        await subscribe(*clients[4], 1)
+        assert [(msg.get('fields'), msg.get('where')) for msg in ext.listeners] == [
+            (None, None),
+            (['tabId'], None),
+            (None, '0.status==complete'),
+            (['tabId'], '0.status==complete'),
+        ]
+        # nor are subscriptions limited to a number of events
+        clients[5][1].write(b'{"id":1,"fn":"subscribe","args":["browser.tabs.onUpdated",3]}\n')
+        assert (await read_reply(clients[5][0]))['data'] == {'subscriptionId': 'browser'}
+        assert len(ext.listeners) == 5
+    run_clients(fn, 6)
+
+def data_reply(id, data, type='data'):
+    return server.Reply(id, True, json.dumps({'id': id, 'type': type, 'data': data, 'complete': True}).encode('utf8'))
+
+def cache_request(cache, conn, id, fn, args=()):
+    reply = cache.on_request(conn, id, fn, json.dumps({'id': id, 'fn': fn, 'args': list(args)}).encode('utf8'))
+    return reply and json.loads(reply.payload)
+
+def test_response_cache_ttl(monkeypatch):
+    now = 100
+    monkeypatch.setattr(server.time, 'monotonic', lambda: now)
+    cache = server.ResponseCache({'a.get': {'ttl': 10}, 'a.forever': {'ttl': None}, 'a.off': None})
+    conn = server.Connection(1)
+
+    for fn in ('a.get', 'a.forever'):
+        assert cache_request(cache, conn, 1, fn) is None
+        cache.on_reply(conn, data_reply(1, fn))
+    # the answer is sent with the id of the request it answers
+    assert cache_request(cache, conn, 'two', 'a.get') == {'id': 'two', 'type': 'data', 'data': 'a.get', 'complete': True}
+    # different arguments are a different answer
+    assert cache_request(cache, conn, 3, 'a.get', [1]) is None
+    cache.on_reply(conn, data_reply(3, 'a.get 1'))
+    assert cache_request(cache, conn, 4, 'a.get', [1])['data'] == 'a.get 1'
+
+    now += 11
+    assert cache_request(cache, conn, 5, 'a.get') is None
+    assert cache_request(cache, conn, 6, 'a.forever')['data'] == 'a.forever'
+    # not cached at all
+    assert cache_request(cache, conn, 7, 'a.off') is None
+    assert 7 not in conn.cacheable
+    assert cache.stats()['hits'] == 3
+
+def test_response_cache_invalidation():
+    control = server.scheduler.control
+    control.clear()
+    cache = server.ResponseCache({
+        'a.query': {'ttl': None, 'invalidate_on': ['a.onChanged']},
+        'b.get': {'ttl': None},
+    })
+    conn = server.Connection(1)
+    def fill():
+        for fn in ('a.query', 'b.get'):
+            if cache_request(cache, conn, 1, fn) is None:
+                cache.on_reply(conn, data_reply(1, fn))
+    def cached():
+        return {entry[1] for entry in cache.entries.values()}
+
+    fill()
+    # a watcher for the event was subscribed to
+    watcher = cache.watchers['a.onChanged']
+    assert [json.loads(data)['args'] for data in control] == [['a.onChanged', None]]
+    control.clear()
+    try:
+        # by a call to another function in the same namespace
+        assert cache_request(cache, conn, 2, 'a.create') is None
+        assert cached() == {'b.get'}
+
+        # by the event, after the reply with the subscription id
+        fill()
+        watcher.on_reply(server.Reply(0, False, b'{"id":0,"type":"data","data":{"subscriptionId":"x"}}'))
+        assert cached() == {'a.query', 'b.get'}
+        assert cache.stats()['watching'] == ['a.onChanged']
+        watcher.on_reply(server.Reply(0, False, b'{"id":0,"type":"data","data":[{}]}'))
+        assert cached() == {'b.get'}
+
+        # by hand
+        fill()
+        cache.invalidate()
+        assert cached() == set()
+
+        # answers that were in flight when it was invalidated are not kept
+        assert cache_request(cache, conn, 3, 'a.query') is None
+        cache.invalidate('a.query')
+        cache.on_reply(conn, data_reply(3, 'stale'))
+        # nor are errors
+        assert cache_request(cache, conn, 4, 'a.query') is None
+        cache.on_reply(conn, data_reply(4, {'error': 'failed'}, 'error'))
+        assert cached() == set()
+        # events are not watched once the subscription ends
+        watcher.on_reply(data_reply(0, None))
+        assert cache.stats()['watching'] == []
+    finally:
+        server.upstream_subscriptions.pop(watcher.conn_id, None)
+        control.clear()
+
+class CountingExtension(Extension):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    async def id(self, msg):
+        self.calls += 1
+        return f'id {self.calls}'
+
+def test_cached_replies_through_the_server():
+    async def main():
+        async with CountingExtension() as ext:
+            reader, writer = await asyncio.open_unix_connection(ext.socket_path)
+            try:
+                for id in (1, 'two', 'a],b'):
+                    writer.write(json.dumps({'id': id, 'fn': 'id', 'args': []}).encode('utf8') + b'\n')
+                    assert await read_reply(reader) == {'id': id, 'type': 'data', 'data': 'id 1', 'complete': True}
+                assert ext.calls == 1
+                stats = await call(reader, writer, b'{"id":4,"fn":"__cache__","args":[]}')
+                assert (stats['hits'], stats['misses']) == (2, 1)
+
+                assert await call(reader, writer, b'{"id":5,"fn":"__cache_invalidate__","args":["id"]}') is True
+                assert await call(reader, writer, b'{"id":6,"fn":"id","args":[]}') == 'id 2'
+                assert await call(reader, writer, b'{"id":7,"fn":"id","args":[]}') == 'id 2'
+            finally:
+                writer.close()
+    asyncio.run(asyncio.wait_for(main(), 10))